@@ -47,12 +47,7 @@ def create_app():
 
     db.init_app(app)
 
-    block_scanner.BlockScanner.set_watched_accounts(
-        [
-            row["public"]
-            for row in db.query_db2('select public from keys where type = "onetime"')
-        ]
-    )
+    block_scanner.BlockScanner.load_watched_accounts()
 
     from . import utils
 
@@ -0,0 +1,109 @@
+import time
+
+from . import metrics
+from .config import config
+from .db import query_db2
+from .leader_lease import LeaderLease
+from .logging import logger
+from .schemas import TronSymbol
+
+
+class ActionDispatcher:
+    """
+    Runs actions on found transfers (sweeps to the main account, AML checks
+    and payouts) written to the action outbox by the block scanner in the
+    same transaction as its progress. An action is removed from the outbox
+    only after it was run or its task was queued, failed ones are retried
+    with the backoff of notifications. Actions may run more than once if
+    the process stops in between, sweeps of an already swept account do
+    nothing.
+    """
+
+    def __init__(self, lease: LeaderLease | None = None):
+        # runs only while the block scanner lease is held, if given
+        self.lease = lease
+
+    def __call__(self):
+        while True:
+            try:
+                if self.lease is not None and not self.lease.is_valid():
+                    time.sleep(config.NOTIFICATION_DISPATCHER_POLL_PERIOD)
+                    continue
+                actions = self.get_due_actions()
+                if not actions:
+                    time.sleep(config.NOTIFICATION_DISPATCHER_POLL_PERIOD)
+                    continue
+                for action in actions:
+                    if self.lease is not None and not self.lease.is_valid():
+                        break
+                    self.dispatch(action)
+            except Exception as e:
+                sleep_sec = 60
+                logger.exception(f"Exteption in action dispatcher loop: {e}")
+                logger.warning(f"Waiting {sleep_sec} seconds before retry.")
+                time.sleep(sleep_sec)
+
+    def get_due_actions(self, limit: int = 100) -> list:
+        return query_db2(
+            "SELECT * FROM action_outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit),
+        )
+
+    def dispatch(self, action):
+        try:
+            logger.info(
+                f"Running {action['action']} for {action['symbol']} TXID {action['txid']}"
+            )
+            run_action(
+                action["action"],
+                TronSymbol(action["symbol"]),
+                action["txid"],
+                action["dst"],
+                action["amount"],
+            )
+        except Exception as e:
+            metrics.actions_failed.inc()
+            self.reschedule(action, e)
+        else:
+            query_db2("DELETE FROM action_outbox WHERE id = ?", (action["id"],))
+
+    def reschedule(self, action, error: Exception):
+        attempts = action["attempts"] + 1
+        delay = min(
+            config.NOTIFICATION_RETRY_MAX_DELAY,
+            config.NOTIFICATION_RETRY_INITIAL_DELAY * 2 ** (attempts - 1),
+        )
+        logger.warning(
+            f"{action['action']} for TXID {action['txid']} failed "
+            f"(attempt {attempts}), retrying in {delay}s: {error}"
+        )
+        query_db2(
+            "UPDATE action_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, str(error), action["id"]),
+        )
+
+
+def run_action(action: str, symbol: TronSymbol, txid: str, dst: str, amount):
+    from .tasks import transfer_trc20_from, transfer_trx_from
+    from .custom.aml.functions import add_transaction_to_db
+    from .custom.aml.tasks import run_payout_for_tx
+
+    if action == "transfer_trc20":
+        if config.DEVMODE_CELERY_NODELAY:
+            transfer_trc20_from(dst, symbol)
+        else:
+            transfer_trc20_from.delay(dst, symbol)
+    elif action == "transfer_trx":
+        transfer_trx_from.delay(dst)
+    elif action == "aml_add_transaction":
+        add_transaction_to_db(txid, dst, amount, symbol)
+    elif action == "aml_add_fee_transaction":
+        add_transaction_to_db(txid, dst, amount, symbol, "from_fee")
+    elif action == "aml_payout":
+        run_payout_for_tx.apply_async(
+            args=[symbol, dst, txid],
+            # wait for 5min for data to be updated in AMLBot
+            countdown=config.AML_WAIT_BEFORE_API_CALL,
+        )
+    else:
+        raise ValueError(f"Unknown action {action}")
@@ -0,0 +1,183 @@
+import hashlib
+import mmap
+import os
+import threading
+
+import base58
+from tronpy.keys import to_base58check_address
+
+# Tron addresses are 0x41 followed by 20 bytes, only the 20 bytes are stored
+KEY_SIZE = 20
+BLOOM_BITS_PER_ADDRESS = 10
+# number of bloom filter hashes, each is 4 bytes of the address
+BLOOM_HASHES = 5
+
+
+def to_key(address) -> bytes:
+    """Converts base58, hex or raw Tron address to 20 bytes."""
+    if isinstance(address, (bytes, bytearray)):
+        return bytes(address[-KEY_SIZE:])
+    if address.startswith("T"):
+        # tronpy's to_hex_address() checks the checksum twice
+        return base58.b58decode_check(address)[-KEY_SIZE:]
+    return bytes.fromhex(address[-KEY_SIZE * 2 :])
+
+
+class AddressSet:
+    """
+    Set of Tron addresses kept as a sorted array of 20-byte keys with a bloom
+    filter in front, a few MB per million addresses instead of hundreds for a
+    set of strings. Membership can be tested with base58, hex (with or
+    without the 41 prefix) or raw addresses, iteration yields base58.
+
+    Added addresses are kept in a regular set until there are enough of them
+    to merge into the array, which is done by a background thread. If `path`
+    is set the array is written to a file named `path` plus a digest of its
+    content and memory-mapped, so processes with the same addresses (e.g.
+    loaded from the database on start) share its pages.
+    """
+
+    MIN_MERGE_SIZE = 1000
+
+    def __init__(self, addresses=(), path: str | None = None):
+        self.path = path
+        self.file_path = None
+        self.lock = threading.Lock()
+        self.is_merging = False
+        self.state = self.build({to_key(address) for address in addresses})
+        self.added = set()
+
+    def build(self, keys: set) -> tuple:
+        data = b"".join(sorted(keys))
+        if self.path and data:
+            data = self.map_file(data)
+        bloom_size = max(8, len(keys) * BLOOM_BITS_PER_ADDRESS)
+        bloom = bytearray((bloom_size + 7) // 8)
+        for key in keys:
+            for bit in self.bloom_bits(key, bloom_size):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        return (bloom, bloom_size, data, len(keys))
+
+    def map_file(self, data: bytes) -> mmap.mmap:
+        """
+        Maps a file with `data`. Files are named after their content and
+        never modified, a file written by another process can be used as is.
+        """
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        file_path = f"{self.path}.{digest}"
+        try:
+            f = open(file_path, "rb")
+        except FileNotFoundError:
+            tmp_path = f"{file_path}.{os.getpid()}.tmp"
+            f = open(tmp_path, "w+b")
+            f.write(data)
+            f.flush()
+            os.replace(tmp_path, file_path)
+        with f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.file_path not in (None, file_path):
+            # processes still using it keep their mapping
+            try:
+                os.remove(self.file_path)
+            except FileNotFoundError:
+                pass
+        self.file_path = file_path
+        return mapped
+
+    @staticmethod
+    def bloom_bits(key: bytes, bloom_size: int):
+        # addresses are hashes already, their bytes are used as bloom hashes
+        for i in range(BLOOM_HASHES):
+            yield int.from_bytes(key[i * 4 : i * 4 + 4], "little") % bloom_size
+
+    def contains_key(self, key: bytes) -> bool:
+        if key in self.added:
+            return True
+        bloom, bloom_size, keys, _ = self.state
+        for bit in self.bloom_bits(key, bloom_size):
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        lo, hi = 0, len(keys) // KEY_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            item = keys[mid * KEY_SIZE : (mid + 1) * KEY_SIZE]
+            if item < key:
+                lo = mid + 1
+            elif item > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __contains__(self, address) -> bool:
+        try:
+            key = to_key(address)
+        except (ValueError, TypeError, AttributeError):
+            return False
+        return len(key) == KEY_SIZE and self.contains_key(key)
+
+    def add(self, address):
+        key = to_key(address)
+        with self.lock:
+            if self.contains_key(key):
+                return
+            self.added.add(key)
+            if not self.is_merging and len(self.added) > max(
+                self.MIN_MERGE_SIZE, self.state[3] // 10
+            ):
+                self.is_merging = True
+                threading.Thread(
+                    target=self.merge, daemon=True, name="Address set merge"
+                ).start()
+
+    def merge(self):
+        """Merges the added addresses into the array."""
+        try:
+            with self.lock:
+                added = frozenset(self.added)
+                keys = self.state[2]
+            state = self.build(
+                {bytes(keys[i : i + KEY_SIZE]) for i in range(0, len(keys), KEY_SIZE)}
+                | added
+            )
+            with self.lock:
+                # Readers don't take the lock. They check the added addresses
+                # before the array, which is replaced before the added
+                # addresses merged into it are dropped.
+                self.state = state
+                self.added = self.added - added
+        finally:
+            self.is_merging = False
+
+    def update(self, addresses):
+        for address in addresses:
+            self.add(address)
+
+    def iter_keys(self):
+        added = list(self.added)
+        keys = self.state[2]
+        for i in range(0, len(keys), KEY_SIZE):
+            yield bytes(keys[i : i + KEY_SIZE])
+        yield from added
+
+    def __iter__(self):
+        for key in self.iter_keys():
+            yield to_base58check_address(b"\x41" + key)
+
+    def __len__(self) -> int:
+        return self.state[3] + len(self.added)
+
+    def __getstate__(self):
+        # sent to match worker processes, they keep their copy in memory
+        return {"keys": b"".join(self.iter_keys())}
+
+    def __setstate__(self, state):
+        self.path = None
+        self.file_path = None
+        self.lock = threading.Lock()
+        self.is_merging = False
+        keys = state["keys"]
+        self.state = self.build(
+            {keys[i : i + KEY_SIZE] for i in range(0, len(keys), KEY_SIZE)}
+        )
+        self.added = set()
@@ -58,7 +58,7 @@ def get_balance():
 def get_status():
     bs = BlockScanner()
     last_seen_block_num = bs.get_last_seen_block_num()
-    block = ConnectionManager.client().get_block(last_seen_block_num)
+    block = bs.download_block(last_seen_block_num)
     return {
         "status": "success",
         "last_block_timestamp": block["block_header"]["raw_data"]["timestamp"] // 1000,
@@ -79,6 +79,7 @@ def get_transaction(txid):
         confirmations = 1
     tron_tx_list = parse_tx(tx, tx_info)
 
+    BlockScanner.sync_watched_accounts()
     result = []
     for info in tron_tx_list:
         if (
@@ -0,0 +1,302 @@
+import asyncio
+import collections
+import time
+from urllib.parse import urljoin
+
+import httpx
+
+from . import json_decoder
+from .block_cache import BlockCache
+from .block_scanner import (
+    BlockScanner,
+    blocks_by_num,
+    check_block_found,
+    record_response,
+    tx_info_by_id,
+)
+from .config import config
+from .connection_manager import ConnectionManager
+from .exceptions import LeaseLost, NoServerSet
+from .logging import logger
+from .scan_controller import AdaptiveController
+
+
+class AsyncBlockScanner(BlockScanner):
+    """
+    Block scanner which downloads blocks and tx infos on one asyncio event
+    loop, keeping up to BLOCK_SCANNER_ASYNC_CONCURRENCY requests in flight.
+
+    Processing is delegated to BlockScanner.scan() and progress is tracked
+    with ScanProgress, so notifications and watermark updates are the same
+    as with the thread based scanner.
+    """
+
+    def __call__(self):
+        while True:
+            try:
+                self.wait_for_lease()
+                asyncio.run(self.run_async_pipeline())
+            except LeaseLost as e:
+                logger.warning(f"Block scanner stopped: {e}")
+                self.clear_pending()
+            except NoServerSet:
+                time.sleep(1)
+            except Exception as e:
+                sleep_sec = 60
+                logger.exception(f"Exteption in main block scanner loop: {e}")
+                logger.warning(f"Waiting {sleep_sec} seconds before retry.")
+                time.sleep(sleep_sec)
+
+    def create_controller(self) -> AdaptiveController:
+        return AdaptiveController(
+            initial=(
+                config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE
+                if config.BLOCK_SCANNER_ADAPTIVE
+                else config.BLOCK_SCANNER_ASYNC_CONCURRENCY
+            ),
+            minimum=config.BLOCK_SCANNER_MIN_FETCH_CONCURRENCY,
+            maximum=config.BLOCK_SCANNER_ASYNC_CONCURRENCY,
+            adaptive=config.BLOCK_SCANNER_ADAPTIVE,
+        )
+
+    async def run_async_pipeline(self):
+        self.controller = self.create_controller()
+        self.semaphore = asyncio.Semaphore(config.BLOCK_SCANNER_ASYNC_CONCURRENCY)
+        limits = httpx.Limits(
+            max_connections=config.BLOCK_SCANNER_ASYNC_CONCURRENCY,
+            max_keepalive_connections=config.BLOCK_SCANNER_ASYNC_CONCURRENCY,
+        )
+        async with httpx.AsyncClient(
+            timeout=config.TRON_CLIENT_TIMEOUT, limits=limits
+        ) as self.http:
+            prefetched = collections.deque()
+            progress = None
+            try:
+                progress = await asyncio.to_thread(self.create_progress)
+                next_block = progress.last_seen + 1
+                current_height = await self.get_current_height_async()
+                self.check_height(next_block - 1, current_height)
+                while True:
+                    await asyncio.to_thread(self.check_lease)
+                    await asyncio.to_thread(self.sync_watched_accounts)
+                    await asyncio.to_thread(self.scan_event_blocks, progress)
+                    for block_num in progress.pop_due_retries():
+                        prefetched.append(
+                            (
+                                block_num,
+                                asyncio.create_task(self.fetch_async(block_num)),
+                            )
+                        )
+                    while (
+                        len(prefetched) < self.controller.concurrency
+                        and next_block <= self.get_poll_height(current_height)
+                        and progress.can_scan(next_block)
+                    ):
+                        batch_size = self.get_batch_size(next_block, current_height)
+                        block_nums = [
+                            n
+                            for n in range(next_block, next_block + batch_size)
+                            if not progress.is_scanned(n)
+                        ]
+                        if len(block_nums) > 1:
+                            blocks = asyncio.create_task(
+                                self.download_block_range_async(
+                                    next_block, next_block + batch_size
+                                )
+                            )
+                        else:
+                            blocks = None
+                        for block_num in block_nums:
+                            prefetched.append(
+                                (
+                                    block_num,
+                                    asyncio.create_task(
+                                        self.fetch_async(block_num, blocks)
+                                    ),
+                                )
+                            )
+                        next_block += batch_size
+
+                    if not prefetched:
+                        logger.debug(
+                            f"Waiting for a new block for {config.BLOCK_SCANNER_INTERVAL_TIME} seconds."
+                        )
+                        if self.event_queue is None:
+                            await asyncio.sleep(config.BLOCK_SCANNER_INTERVAL_TIME)
+                        else:
+                            await asyncio.to_thread(self.wait_for_new_block, progress)
+                        current_height = await self.get_current_height_async()
+                        self.check_height(next_block - 1, current_height)
+                        continue
+
+                    block_num, task = prefetched.popleft()
+                    start_time = time.time()
+                    try:
+                        block, block_tx_info = await task
+                    except Exception as e:
+                        logger.exception(f"Block {block_num}: Failed to download: {e}")
+                        is_scanned = False
+                    else:
+                        # scan() blocks on database queries, keep the event
+                        # loop free for downloads meanwhile
+                        is_scanned = await asyncio.to_thread(
+                            self.scan, block_num, block, block_tx_info
+                        )
+
+                    if is_scanned:
+                        progress.mark_scanned(block_num)
+                        logger.debug(
+                            f"Block {block_num} processed for {time.time() - start_time} seconds"
+                        )
+                        self.controller.update(lag=current_height - block_num)
+                    else:
+                        progress.mark_failed(block_num)
+                        logger.info(
+                            f"Block {block_num} failed, retrying after {config.BLOCK_SCANNER_RETRY_PERIOD}s"
+                        )
+
+                    if progress.uncommitted and (
+                        len(progress.uncommitted) >= self.controller.commit_batch_size
+                        or not prefetched
+                        or not prefetched[0][1].done()
+                    ):
+                        await asyncio.to_thread(self.commit_progress, progress)
+
+                    if next_block > current_height:
+                        current_height = await self.get_current_height_async()
+                        self.check_height(next_block - 1, current_height)
+            finally:
+                for _, task in prefetched:
+                    task.cancel()
+                if progress is not None and progress.uncommitted:
+                    await asyncio.to_thread(self.commit_progress, progress)
+
+    async def make_request_async(
+        self, method: str, params: dict, block_num: int | None = None
+    ):
+        manager = ConnectionManager.manager()
+        if block_num is None:
+            server_id = manager.get_current_server_id()
+            if server_id is None:
+                raise NoServerSet("Current server is not set.")
+        else:
+            server_id = manager.get_download_server_id(block_num)
+        url = urljoin(manager.servers[server_id].url, method)
+        async with self.semaphore:
+            start_time = time.perf_counter()
+            try:
+                resp = await self.http.post(url, json=params)
+                resp.raise_for_status()
+            except Exception:
+                if block_num is not None:
+                    manager.record_download(
+                        server_id, time.perf_counter() - start_time, False
+                    )
+                raise
+            seconds = time.perf_counter() - start_time
+            if block_num is not None:
+                manager.record_download(server_id, seconds, True)
+        record_response(method, seconds, len(resp.content))
+        return json_decoder.loads(resp.content, method)
+
+    async def get_current_height_async(self) -> int:
+        block = await self.make_request_async("wallet/getnowblock", {"visible": False})
+        n = block["block_header"]["raw_data"]["number"]
+        logger.debug(f"Block height is {n}")
+        return n
+
+    async def download_block_async(self, n: int) -> dict:
+        block_cache = BlockCache.get_instance()
+        if block := await asyncio.to_thread(block_cache.get, "block", n):
+            return block
+        start_time = time.time()
+        block = await self.make_request_async(
+            "wallet/getblockbynum", {"num": n, "visible": False}, block_num=n
+        )
+        check_block_found(n, block)
+        logger.debug(f"Block {n} download took {time.time() - start_time} seconds")
+        block_cache.put("block", n, block)
+        return block
+
+    async def download_block_range_async(self, start: int, stop: int) -> dict:
+        start_time = time.time()
+        result = await self.make_request_async(
+            "wallet/getblockbylimitnext",
+            {"startNum": start, "endNum": stop, "visible": False},
+            block_num=stop - 1,
+        )
+        blocks = blocks_by_num(result)
+        logger.debug(
+            f"Blocks {start} - {stop - 1} download took {time.time() - start_time} seconds"
+        )
+        for n, block in blocks.items():
+            BlockCache.get_instance().put("block", n, block)
+        return blocks
+
+    async def download_tx_info_by_block_num_async(self, n: int) -> dict:
+        block_cache = BlockCache.get_instance()
+        block_tx_info = await asyncio.to_thread(block_cache.get, "tx_info", n)
+        if block_tx_info is not None:
+            return block_tx_info
+        start_time = time.time()
+        transaction_results = await self.make_request_async(
+            "wallet/gettransactioninfobyblocknum",
+            {"num": n, "visible": False},
+            block_num=n,
+        )
+        logger.debug(
+            f"Tx info for block {n} download took {time.time() - start_time} seconds"
+        )
+        block_tx_info = tx_info_by_id(transaction_results)
+        block_cache.put("tx_info", n, block_tx_info)
+        return block_tx_info
+
+    async def download_tx_info_by_ids_async(self, n: int, txids: list) -> dict:
+        start_time = time.time()
+        transaction_results = await asyncio.gather(
+            *[
+                self.make_request_async(
+                    "wallet/gettransactioninfobyid",
+                    {"value": txid, "visible": False},
+                    block_num=n,
+                )
+                for txid in txids
+            ]
+        )
+        logger.debug(
+            f"Tx info for {len(txids)} transactions download took {time.time() - start_time} seconds"
+        )
+        return tx_info_by_id(transaction_results)
+
+    async def fetch_async(
+        self, block_num: int, blocks: asyncio.Task | None = None
+    ) -> tuple[dict, dict]:
+        start_time = time.perf_counter()
+        is_fetched = False
+        try:
+            block = None
+            if blocks is not None:
+                try:
+                    block = (await blocks).get(block_num)
+                except Exception as e:
+                    logger.warning(
+                        f"Block {block_num}: Range download failed, "
+                        f"downloading the block alone: {e}"
+                    )
+            if block is None:
+                block = await self.download_block_async(block_num)
+            mode, txids = self.get_tx_info_mode(block_num, block)
+            if mode == "by_id":
+                block_tx_info = await self.download_tx_info_by_ids_async(
+                    block_num, txids
+                )
+            elif mode == "by_block":
+                block_tx_info = await self.download_tx_info_by_block_num_async(
+                    block_num
+                )
+            else:
+                block_tx_info = {}
+            is_fetched = True
+            return block, block_tx_info
+        finally:
+            self.record_fetch_time(time.perf_counter() - start_time, is_fetched)
@@ -0,0 +1,150 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+from . import json_decoder
+from .config import config
+from .logging import logger
+
+
+class BlockCache:
+    """
+    Bounded on-disk cache of fullnode responses (blocks and their tx infos)
+    shared by the block scanner and API processes. Entries are stored
+    compressed in a SQLite database, least recently used entries are evicted
+    when there are more than BLOCK_CACHE_MAX_ENTRIES of them.
+
+    Entries are serialized and written by a background thread, put() only
+    queues them and never blocks the block scanner. Queued entries are
+    served from memory until written, entries which don't fit in the queue
+    (BLOCK_CACHE_WRITE_QUEUE_SIZE) are not cached.
+    """
+
+    instance = None
+    EVICTION_PERIOD = 100  # check cache size every N inserts
+
+    @classmethod
+    def get_instance(cls) -> "BlockCache":
+        if not cls.instance:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.inserts = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.write_queue = None
+        self.writer_pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return config.BLOCK_CACHE_MAX_ENTRIES > 0
+
+    def get_db(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(
+                config.BLOCK_CACHE_DATABASE, isolation_level=None, timeout=30
+            )
+            db.execute("pragma journal_mode=wal;")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "  kind TEXT NOT NULL,"
+                "  num INTEGER NOT NULL,"
+                "  data BLOB NOT NULL,"
+                "  accessed_at REAL NOT NULL,"
+                "  PRIMARY KEY (kind, num)"
+                ")"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+            self.local.db = db
+        return db
+
+    def get(self, kind: str, num: int):
+        if not self.enabled:
+            return None
+        with self.lock:
+            value = self.pending.get((kind, num))
+        if value is not None:
+            return value
+        db = self.get_db()
+        row = db.execute(
+            "SELECT data FROM cache WHERE kind = ? AND num = ?", (kind, num)
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            "UPDATE cache SET accessed_at = ? WHERE kind = ? AND num = ?",
+            (time.time(), kind, num),
+        )
+        return json_decoder.loads(zlib.decompress(row[0]))
+
+    def put(self, kind: str, num: int, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.writer_pid != os.getpid():
+                # not started yet or forked, the writer thread isn't copied
+                self.pending = {}
+                self.write_queue = queue.Queue(config.BLOCK_CACHE_WRITE_QUEUE_SIZE)
+                self.writer_pid = os.getpid()
+                threading.Thread(
+                    target=self.run_writer,
+                    args=(self.write_queue,),
+                    daemon=True,
+                    name="Block cache writer",
+                ).start()
+            try:
+                self.write_queue.put_nowait((kind, num))
+            except queue.Full:
+                logger.debug(f"Block cache write queue is full, {kind} {num} skipped")
+                return
+            self.pending[(kind, num)] = value
+
+    def run_writer(self, write_queue: queue.Queue):
+        while True:
+            kind, num = write_queue.get()
+            with self.lock:
+                value = self.pending.get((kind, num))
+            try:
+                if value is not None:
+                    self.write(kind, num, value)
+            except Exception as e:
+                logger.warning(f"Failed to write {kind} {num} to block cache: {e}")
+            finally:
+                with self.lock:
+                    if value is not None and self.pending.get((kind, num)) is value:
+                        del self.pending[(kind, num)]
+
+    def write(self, kind: str, num: int, value):
+        data = zlib.compress(json.dumps(value).encode(), 1)
+        self.get_db().execute(
+            "INSERT OR REPLACE INTO cache (kind, num, data, accessed_at) VALUES (?, ?, ?, ?)",
+            (kind, num, data, time.time()),
+        )
+        with self.lock:
+            self.inserts += 1
+            evict = self.inserts % self.EVICTION_PERIOD == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        start_time = time.time()
+        db = self.get_db()
+        cur = db.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            "  SELECT rowid FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?"
+            ")",
+            (config.BLOCK_CACHE_MAX_ENTRIES,),
+        )
+        logger.debug(
+            f"Evicted {cur.rowcount} block cache entries in {time.time() - start_time} seconds"
+        )
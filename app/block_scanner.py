@@ -1,64 +1,90 @@
+import collections
 import datetime
+from dataclasses import dataclass, field
 from decimal import Decimal
 import functools
+import multiprocessing
+import queue
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import List
 
-import requests
-
 from tronpy.abi import trx_abi
+from tronpy.exceptions import BlockNotFound
+from tronpy.keys import to_base58check_address, to_hex_address
 from eth_abi.exceptions import NonEmptyPaddingBytes, InsufficientDataBytes
 
 from .schemas import TronTransaction
 
+from . import json_decoder, metrics
+from .address_set import AddressSet
+from .block_cache import BlockCache
+from .scan_controller import AdaptiveController
 from .config import config
-from .db import query_db2
+from .db import query_db2, transaction_db2
 from .logging import logger
 from .exceptions import (
+    LeaseLost,
     NoServerSet,
     UnknownToken,
     UnknownTransactionType,
-    NotificationFailed,
     BadContractResult,
 )
 from .connection_manager import ConnectionManager
+from .leader_lease import LeaderLease
+
+# wallet/getblockbylimitnext returns at most 100 blocks per call
+MAX_BLOCK_RANGE_SIZE = 100
+
+# >>> from tronpy.contract import keccak256
+# >>> bytes.hex(keccak256("Transfer(address,address,uint256)".encode()))
+# 'ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+TRANSFER_EVENT = "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
 
 
 class BlockScanner:
-    WATCHED_ACCOUNTS = set()
+    WATCHED_ACCOUNTS = AddressSet()
+    # accounts added since the match pool was started as hex, in order, for
+    # its workers. None if there is no match pool or it has to be restarted.
+    WATCHED_ACCOUNTS_HEX_ADDED = None
+    # id of the last onetime key in WATCHED_ACCOUNTS, see sync_watched_accounts()
+    WATCHED_ACCOUNTS_LAST_KEY_ID = 0
+    WATCHED_ACCOUNTS_SYNCED_AT = 0
+    WATCHED_ACCOUNTS_SYNC_LOCK = threading.Lock()
+    # max number of accounts sent to match workers with each block
+    MAX_ADDED_ACCOUNTS_PER_TASK = 1000
+
+    def __init__(self, lease: LeaderLease | None = None):
+        # only one scanner sharing the database runs while holding the lease
+        self.lease = lease
+        # notifications, processed transfers and actions of scanned
+        # blocks waiting for the watermark update
+        self.pending_notifications = []
+        self.pending_transfers = {}
+        self.pending_actions = []
+        self.block_notifications = []
+        self.block_transfers = []
+        self.block_actions = []
+        # blocks received by EventListener
+        if config.EVENT_LISTENER_ENABLED:
+            self.event_queue = queue.Queue(config.EVENT_LISTENER_QUEUE_SIZE)
+        else:
+            self.event_queue = None
+        self.match_pool = None
+        self.match_pool_accounts_hex = None
+        self.match_pool_lock = threading.Lock()
 
     def __call__(self):
-        with ThreadPoolExecutor(
-            max_workers=config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE
-        ) as executor:
+        with ThreadPoolExecutor(max_workers=self.get_max_fetch_workers()) as executor:
             while True:
                 try:
-                    blocks = self.get_blocks()
-                    if blocks.start == blocks.stop:
-                        logger.debug(
-                            f"Waiting for a new block for {config.BLOCK_SCANNER_INTERVAL_TIME} seconds."
-                        )
-                        time.sleep(config.BLOCK_SCANNER_INTERVAL_TIME)
-                        continue
-
-                    start_time = time.time()
-                    results = list(executor.map(self.scan, blocks))
-                    logger.debug(
-                        f"Block chunk {blocks.start} - {blocks.stop - 1} processed for {time.time() - start_time} seconds"
-                    )
-
-                    if results and all(results):
-                        logger.debug(
-                            f"Commiting chunk {blocks.start} - {blocks.stop - 1}"
-                        )
-                        self.set_last_seen_block_num(blocks.stop - 1)
-                    else:
-                        chunk_retry_sleep_period = 5
-                        logger.info(
-                            f"Some blocks failed, retrying chunk {blocks.start} - {blocks.stop - 1} after {chunk_retry_sleep_period}s"
-                        )
-                        time.sleep(chunk_retry_sleep_period)
+                    self.wait_for_lease()
+                    self.run_pipeline(executor)
+                except LeaseLost as e:
+                    logger.warning(f"Block scanner stopped: {e}")
+                    self.clear_pending()
                 except NoServerSet:
                     time.sleep(1)
                 except Exception as e:
@@ -67,20 +93,259 @@ class BlockScanner:
                     logger.warning(f"Waiting {sleep_sec} seconds before retry.")
                     time.sleep(sleep_sec)
 
+    def get_max_fetch_workers(self) -> int:
+        if config.BLOCK_SCANNER_ADAPTIVE:
+            return config.BLOCK_SCANNER_MAX_FETCH_CONCURRENCY
+        return config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE
+
+    def create_controller(self) -> AdaptiveController:
+        if config.BLOCK_SCANNER_ADAPTIVE:
+            initial = config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE
+        else:
+            initial = config.BLOCK_SCANNER_PREFETCH_SIZE
+        return AdaptiveController(
+            initial=initial,
+            minimum=config.BLOCK_SCANNER_MIN_FETCH_CONCURRENCY,
+            maximum=config.BLOCK_SCANNER_MAX_FETCH_CONCURRENCY,
+            adaptive=config.BLOCK_SCANNER_ADAPTIVE,
+        )
+
+    def run_pipeline(self, executor: ThreadPoolExecutor):
+        """
+        Downloads blocks ahead of the processing stage and processes them as
+        they arrive. The number of blocks downloaded ahead and the number of
+        processed blocks per commit are chosen by the AdaptiveController.
+        A failed block is retried later on its own while the blocks after it
+        are scanned, see ScanProgress.
+        """
+        self.controller = self.create_controller()
+        prefetched = collections.deque()
+        progress = None
+        try:
+            progress = self.create_progress()
+            next_block = progress.last_seen + 1
+            current_height = self.get_current_height()
+            self.check_height(next_block - 1, current_height)
+            while True:
+                self.check_lease()
+                self.sync_watched_accounts()
+                self.scan_event_blocks(progress)
+                for block_num in progress.pop_due_retries():
+                    prefetched.append(
+                        (block_num, executor.submit(self.fetch, block_num))
+                    )
+                while (
+                    len(prefetched) < self.controller.concurrency
+                    and next_block <= self.get_poll_height(current_height)
+                    and progress.can_scan(next_block)
+                ):
+                    if self.is_catching_up(next_block, current_height):
+                        if not progress.is_scanned(next_block):
+                            prefetched.append(
+                                (
+                                    next_block,
+                                    executor.submit(self.fetch_catchup, next_block),
+                                )
+                            )
+                        next_block += 1
+                        continue
+                    batch_size = self.get_batch_size(next_block, current_height)
+                    block_nums = [
+                        n
+                        for n in range(next_block, next_block + batch_size)
+                        if not progress.is_scanned(n)
+                    ]
+                    if len(block_nums) > 1:
+                        # The range download is submitted before the per-block
+                        # fetches waiting on it, so it is always picked up by a
+                        # worker first and can't be starved by them.
+                        blocks = executor.submit(
+                            self.download_block_range,
+                            next_block,
+                            next_block + batch_size,
+                        )
+                    else:
+                        blocks = None
+                    for block_num in block_nums:
+                        prefetched.append(
+                            (block_num, executor.submit(self.fetch, block_num, blocks))
+                        )
+                    next_block += batch_size
+
+                if not prefetched:
+                    logger.debug(
+                        f"Waiting for a new block for {config.BLOCK_SCANNER_INTERVAL_TIME} seconds."
+                    )
+                    self.wait_for_new_block(progress)
+                    current_height = self.get_current_height()
+                    self.check_height(next_block - 1, current_height)
+                    continue
+
+                block_num, future = prefetched.popleft()
+                start_time = time.time()
+                try:
+                    fetched = future.result()
+                except Exception as e:
+                    logger.exception(f"Block {block_num}: Failed to download: {e}")
+                    is_scanned = False
+                else:
+                    is_scanned = self.scan(block_num, *fetched)
+
+                if is_scanned:
+                    progress.mark_scanned(block_num)
+                    logger.debug(
+                        f"Block {block_num} processed for {time.time() - start_time} seconds"
+                    )
+                    self.controller.update(lag=current_height - block_num)
+                else:
+                    progress.mark_failed(block_num)
+                    logger.info(
+                        f"Block {block_num} failed, retrying after {config.BLOCK_SCANNER_RETRY_PERIOD}s"
+                    )
+
+                if progress.uncommitted and (
+                    len(progress.uncommitted) >= self.controller.commit_batch_size
+                    or not prefetched
+                    or not prefetched[0][1].done()
+                ):
+                    self.commit_progress(progress)
+
+                if next_block > current_height:
+                    current_height = self.get_current_height()
+                    self.check_height(next_block - 1, current_height)
+        finally:
+            for _, future in prefetched:
+                future.cancel()
+            if progress is not None and progress.uncommitted:
+                self.commit_progress(progress)
+
+    def clear_pending(self):
+        # the blocks are scanned again by the new lease holder
+        self.pending_notifications = []
+        self.pending_transfers = {}
+        self.pending_actions = []
+
+    def wait_for_lease(self):
+        if self.lease is not None:
+            self.lease.wait()
+
+    def check_lease(self):
+        if self.lease is not None:
+            self.lease.check()
+
+    def get_poll_height(self, current_height: int) -> int:
+        """
+        Returns the last block to download. With the event listener blocks
+        are downloaded only if they weren't received from events in time.
+        """
+        if self.event_queue is None:
+            return current_height
+        return current_height - config.EVENT_LISTENER_POLL_DELAY
+
+    def wait_for_new_block(self, progress: "ScanProgress"):
+        if self.event_queue is None:
+            time.sleep(config.BLOCK_SCANNER_INTERVAL_TIME)
+        else:
+            self.scan_event_blocks(progress, timeout=config.BLOCK_SCANNER_INTERVAL_TIME)
+
+    def scan_event_blocks(self, progress: "ScanProgress", timeout: float = 0):
+        """
+        Scans blocks received by EventListener, waiting up to `timeout`
+        seconds for the first one. Blocks failed to scan are left to polling.
+        """
+        if self.event_queue is None:
+            return
+        try:
+            if timeout:
+                item = self.event_queue.get(timeout=timeout)
+            else:
+                item = self.event_queue.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            block_num, block, block_tx_info = item
+            if not progress.is_scanned(block_num) and self.scan(
+                block_num, block, block_tx_info
+            ):
+                progress.mark_scanned(block_num)
+            try:
+                item = self.event_queue.get_nowait()
+            except queue.Empty:
+                break
+        if progress.uncommitted:
+            self.commit_progress(progress)
+
+    def create_progress(self) -> "ScanProgress":
+        last_seen_block_num = self.get_last_seen_block_num()
+        return ScanProgress(
+            last_seen_block_num, self.get_scanned_blocks(last_seen_block_num)
+        )
+
+    def commit_progress(self, progress: "ScanProgress"):
+        scanned_blocks = progress.get_uncommitted()
+        self.set_last_seen_block_num(progress.last_seen, scanned_blocks)
+        progress.uncommitted.clear()
+
     @classmethod
-    def get_watched_accounts(cls) -> list:
+    def get_watched_accounts(cls) -> AddressSet:
+        return cls.WATCHED_ACCOUNTS
+
+    @classmethod
+    def get_watched_accounts_hex(cls) -> AddressSet:
+        # AddressSet matches 20-byte hex addresses of visible=False blocks too
         return cls.WATCHED_ACCOUNTS
 
     @classmethod
     def set_watched_accounts(cls, acc_list: list):
-        cls.WATCHED_ACCOUNTS = set(acc_list)
+        cls.WATCHED_ACCOUNTS = AddressSet(acc_list, path=config.WATCHED_ACCOUNTS_FILE)
+        cls.WATCHED_ACCOUNTS_HEX_ADDED = None
         logger.debug(
             f"WATCHED_ACCOUNTS was set. List size: {cls.count_watched_accounts()}"
         )
 
+    @classmethod
+    def load_watched_accounts(cls):
+        with cls.WATCHED_ACCOUNTS_SYNC_LOCK:
+            rows = query_db2('SELECT id, public FROM keys WHERE type = "onetime"')
+            cls.set_watched_accounts([row["public"] for row in rows])
+            cls.WATCHED_ACCOUNTS_LAST_KEY_ID = max(
+                (row["id"] for row in rows), default=0
+            )
+            cls.WATCHED_ACCOUNTS_SYNCED_AT = time.monotonic()
+
+    @classmethod
+    def sync_watched_accounts(cls):
+        """
+        Adds onetime accounts created since the last load or sync, possibly by
+        other processes. Runs at most once per WATCHED_ACCOUNTS_SYNC_PERIOD.
+        """
+        if (
+            time.monotonic() - cls.WATCHED_ACCOUNTS_SYNCED_AT
+            < config.WATCHED_ACCOUNTS_SYNC_PERIOD
+        ):
+            return
+        with cls.WATCHED_ACCOUNTS_SYNC_LOCK:
+            rows = query_db2(
+                'SELECT id, public FROM keys WHERE type = "onetime" AND id > ? ORDER BY id',
+                (cls.WATCHED_ACCOUNTS_LAST_KEY_ID,),
+            )
+            for row in rows:
+                cls.add_watched_account(row["public"])
+                cls.WATCHED_ACCOUNTS_LAST_KEY_ID = row["id"]
+            cls.WATCHED_ACCOUNTS_SYNCED_AT = time.monotonic()
+
     @classmethod
     def add_watched_account(cls, acc: str):
+        if acc in cls.WATCHED_ACCOUNTS:
+            return
         cls.WATCHED_ACCOUNTS.add(acc)
+        added = cls.WATCHED_ACCOUNTS_HEX_ADDED
+        if added is not None:
+            if len(added) < cls.MAX_ADDED_ACCOUNTS_PER_TASK:
+                added.append(to_raw_hex_address(acc))
+            else:
+                # too many to send with each block, restart the match pool
+                cls.WATCHED_ACCOUNTS_HEX_ADDED = None
         logger.debug(
             f"Added {acc} to WATCHED_ACCOUNTS. List size: {cls.count_watched_accounts()}"
         )
@@ -116,12 +381,76 @@ class BlockScanner:
             )
         return last_block_num
 
-    def set_last_seen_block_num(self, block_num: int):
-        start_time = time.time()
-        query_db2(
-            'UPDATE settings SET value = ? WHERE name = "last_seen_block_num"',
-            (block_num,),
+    def get_scanned_blocks(self, last_seen_block_num: int) -> list:
+        rows = query_db2(
+            "SELECT block_num FROM scanned_blocks WHERE block_num > ?",
+            (last_seen_block_num,),
         )
+        return [row["block_num"] for row in rows]
+
+    def set_last_seen_block_num(self, block_num: int, scanned_blocks: list = ()):
+        """
+        Moves the watermark, stores `scanned_blocks` above it as completed and
+        writes notifications and processed transfers of the scanned blocks in
+        the same transaction. Raises LeaseLost without writing anything if
+        the lease is not held anymore. Processed transfers more than
+        BLOCK_SCANNER_PROCESSED_TRANSFERS_MARGIN blocks below the watermark
+        are deleted, those blocks are not scanned again. Actions on the
+        transfers are written to the action outbox, ActionDispatcher runs
+        them.
+        """
+        start_time = time.time()
+        notifications = self.pending_notifications
+        transfers = self.pending_transfers
+        actions = self.pending_actions
+        self.pending_notifications = []
+        self.pending_transfers = {}
+        self.pending_actions = []
+        try:
+            with transaction_db2() as db:
+                if self.lease is not None:
+                    self.lease.fence(db)
+                db.executemany(
+                    "INSERT INTO notification_outbox (symbol, txid, src, dst, amount, block_num) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (n.symbol.value, n.txid, n.src_addr, n.dst_addr, n.amount, n.block_num)
+                        for n in notifications
+                    ],
+                )
+                db.executemany(
+                    "INSERT INTO action_outbox (action, symbol, txid, dst, amount, block_num) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (action, t.symbol.value, t.txid, t.dst_addr, t.amount, t.block_num)
+                        for action, t in actions
+                    ],
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO processed_transfers (txid, log_index, block_num) "
+                    "VALUES (?, ?, ?)",
+                    [(txid, log_index, n) for (txid, log_index), n in transfers.items()],
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO scanned_blocks (block_num) VALUES (?)",
+                    [(n,) for n in scanned_blocks],
+                )
+                db.execute(
+                    "DELETE FROM scanned_blocks WHERE block_num <= ?", (block_num,)
+                )
+                db.execute(
+                    "DELETE FROM processed_transfers WHERE block_num < ?",
+                    (block_num - config.BLOCK_SCANNER_PROCESSED_TRANSFERS_MARGIN,),
+                )
+                db.execute(
+                    'UPDATE settings SET value = ? WHERE name = "last_seen_block_num"',
+                    (block_num,),
+                )
+        except Exception:
+            self.pending_notifications = notifications + self.pending_notifications
+            self.pending_transfers = transfers | self.pending_transfers
+            self.pending_actions = actions + self.pending_actions
+            raise
         logger.debug(
             f"set_last_seen_block_num({block_num}) save time: {time.time() - start_time} seconds"
         )
@@ -131,183 +460,327 @@ class BlockScanner:
         logger.debug(f"Block height is {n}")
         return n
 
-    def get_blocks(self):
-        last_seen_block_num = self.get_last_seen_block_num()
-        next_block = last_seen_block_num + 1
-        current_height = self.get_current_height()
-        if last_seen_block_num > current_height:
+    def check_height(self, last_seen_block_num: int, current_height: int):
+        drop = last_seen_block_num - current_height
+        if 0 < drop <= config.MULTISERVER_MAX_BLOCK_LAG:
+            # a server a few blocks behind, e.g. after a server switch, new
+            # blocks are downloaded once it catches up
+            logger.info(
+                f"Tron fullnode height {current_height} is behind block "
+                f"{last_seen_block_num}, waiting for it to catch up"
+            )
+            return
+        if drop > 0:
             raise Exception(
                 f"Tron fullnode height unexpectedly dropped from {last_seen_block_num} to {current_height}. Refusing to continue."
             )
-        target_block = next_block + config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE
-        if target_block > current_height:
-            target_block = current_height
-        return range(next_block, target_block + 1)
 
-    @functools.lru_cache(maxsize=config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE)
+    def get_batch_size(self, next_block: int, current_height: int) -> int:
+        batch_size = min(config.BLOCK_SCANNER_BLOCK_BATCH_SIZE, MAX_BLOCK_RANGE_SIZE)
+        if batch_size > 1 and next_block + batch_size - 1 <= current_height:
+            return batch_size
+        # Near the chain head: fetch blocks one by one
+        return 1
+
+    def make_request(
+        self, method: str, params: dict, block_num: int | None = None, raw=False
+    ):
+        """
+        Same as HTTPProvider.make_request() but records the response size.
+        Requests for `block_num` data are spread across the servers that
+        have the block. Returns the undecoded response body if `raw` is set.
+        """
+        manager = ConnectionManager.manager()
+        if block_num is None:
+            return self.send_request(manager.client().provider, method, params, raw)
+
+        server_id = manager.get_download_server_id(block_num)
+        provider = manager.get_client_for_server_id(server_id).provider
+        start_time = time.perf_counter()
+        try:
+            result = self.send_request(provider, method, params, raw)
+        except Exception:
+            manager.record_download(server_id, time.perf_counter() - start_time, False)
+            raise
+        manager.record_download(server_id, time.perf_counter() - start_time, True)
+        return result
+
+    def send_request(self, provider, method: str, params: dict, raw=False):
+        start_time = time.perf_counter()
+        resp = provider.sess.post(
+            urljoin(provider.endpoint_uri, method),
+            json=params,
+            timeout=provider.timeout,
+        )
+        resp.raise_for_status()
+        record_response(method, time.perf_counter() - start_time, len(resp.content))
+        if raw:
+            return resp.content
+        return json_decoder.loads(resp.content, method)
+
     def download_block(self, n):
+        if block := BlockCache.get_instance().get("block", n):
+            return block
         start_time = time.time()
-        block = ConnectionManager.client().get_block(n)
+        block = self.make_request(
+            "wallet/getblockbynum", {"num": n, "visible": False}, block_num=n
+        )
+        check_block_found(n, block)
         logger.debug(f"Block {n} download took {time.time() - start_time} seconds")
+        BlockCache.get_instance().put("block", n, block)
         return block
 
-    @functools.lru_cache(maxsize=config.BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE)
     def download_tx_info_by_block_num(self, n):
+        block_tx_info = BlockCache.get_instance().get("tx_info", n)
+        if block_tx_info is not None:
+            return block_tx_info
         start_time = time.time()
-        transaction_results = ConnectionManager.client().provider.make_request(
-            "wallet/gettransactioninfobyblocknum", {"num": n, "visible": True}
+        transaction_results = self.make_request(
+            "wallet/gettransactioninfobyblocknum",
+            {"num": n, "visible": False},
+            block_num=n,
         )
         logger.debug(
             f"Tx info for block {n} download took {time.time() - start_time} seconds"
         )
-        return {
-            result["id"]: result for result in transaction_results if "log" in result
-        }
+        block_tx_info = tx_info_by_id(transaction_results)
+        BlockCache.get_instance().put("tx_info", n, block_tx_info)
+        return block_tx_info
+
+    def download_tx_info_by_ids(self, n: int, txids: list) -> dict:
+        start_time = time.time()
+        transaction_results = [
+            self.make_request(
+                "wallet/gettransactioninfobyid",
+                {"value": txid, "visible": False},
+                block_num=n,
+            )
+            for txid in txids
+        ]
+        logger.debug(
+            f"Tx info for {len(txids)} transactions download took {time.time() - start_time} seconds"
+        )
+        return tx_info_by_id(transaction_results)
+
+    def download_block_range(self, start: int, stop: int) -> dict:
+        start_time = time.time()
+        result = self.make_request(
+            "wallet/getblockbylimitnext",
+            {"startNum": start, "endNum": stop, "visible": False},
+            block_num=stop - 1,
+        )
+        blocks = blocks_by_num(result)
+        logger.debug(
+            f"Blocks {start} - {stop - 1} download took {time.time() - start_time} seconds"
+        )
+        for n, block in blocks.items():
+            BlockCache.get_instance().put("block", n, block)
+        return blocks
+
+    def fetch(self, block_num: int, blocks: Future | None = None) -> tuple[dict, dict]:
+        start_time = time.perf_counter()
+        is_fetched = False
+        try:
+            block = None
+            if blocks is not None:
+                try:
+                    block = blocks.result().get(block_num)
+                except Exception as e:
+                    logger.warning(
+                        f"Block {block_num}: Range download failed, "
+                        f"downloading the block alone: {e}"
+                    )
+            if block is None:
+                block = self.download_block(block_num)
+            mode, txids = self.get_tx_info_mode(block_num, block)
+            if mode == "by_id":
+                block_tx_info = self.download_tx_info_by_ids(block_num, txids)
+            elif mode == "by_block":
+                block_tx_info = self.download_tx_info_by_block_num(block_num)
+            else:
+                block_tx_info = {}
+            is_fetched = True
+            return block, block_tx_info
+        finally:
+            self.record_fetch_time(time.perf_counter() - start_time, is_fetched)
+
+    def is_catching_up(self, next_block: int, current_height: int) -> bool:
+        return (
+            config.BLOCK_SCANNER_CATCHUP_PROCESSES > 0
+            and current_height - next_block >= config.BLOCK_SCANNER_CATCHUP_MIN_LAG
+        )
+
+    def get_match_pool(self) -> tuple[ProcessPoolExecutor, tuple]:
+        """
+        Returns the pool of match worker processes and the watched accounts
+        added since the pool was started. Workers get a snapshot of the
+        watched accounts on start, the pool is restarted when the accounts
+        are replaced or too many were added.
+        """
+        with self.match_pool_lock:
+            accounts_hex = self.get_watched_accounts_hex()
+            added = self.WATCHED_ACCOUNTS_HEX_ADDED
+            if (
+                self.match_pool is None
+                or self.match_pool_accounts_hex is not accounts_hex
+                or added is None
+            ):
+                if self.match_pool is not None:
+                    self.match_pool.shutdown(wait=False)
+                # Workers get the accounts when they are started, after this.
+                # Accounts added meanwhile are sent to them once more.
+                type(self).WATCHED_ACCOUNTS_HEX_ADDED = []
+                self.match_pool_accounts_hex = accounts_hex
+                self.match_pool = ProcessPoolExecutor(
+                    max_workers=config.BLOCK_SCANNER_CATCHUP_PROCESSES,
+                    # don't fork the threads of the scanner process
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_match_worker,
+                    initargs=(accounts_hex,),
+                )
+                added = []
+                logger.info(
+                    f"Started {config.BLOCK_SCANNER_CATCHUP_PROCESSES} match worker processes"
+                )
+            return self.match_pool, tuple(added)
+
+    def fetch_catchup(self, block_num: int) -> tuple[None, None, "MatchResult"]:
+        """
+        Downloads the block and its tx info without decoding them and
+        decodes and matches them in a match worker process.
+        """
+        start_time = time.perf_counter()
+        is_fetched = False
+        try:
+            raw_block = self.make_request(
+                "wallet/getblockbynum",
+                {"num": block_num, "visible": False},
+                block_num=block_num,
+                raw=True,
+            )
+            raw_tx_info = self.make_request(
+                "wallet/gettransactioninfobyblocknum",
+                {"num": block_num, "visible": False},
+                block_num=block_num,
+                raw=True,
+            )
+            is_fetched = True
+        finally:
+            self.record_fetch_time(time.perf_counter() - start_time, is_fetched)
+        pool, added = self.get_match_pool()
+        result = pool.submit(
+            match_raw_block, block_num, raw_block, raw_tx_info, added
+        ).result()
+        return None, None, result
+
+    def record_fetch_time(self, seconds: float, is_fetched: bool):
+        self.record_stage_time("download", seconds)
+        self.controller.record_fetch(seconds, is_fetched)
+
+    def get_tx_info_mode(self, block_num: int, block: dict) -> tuple[str, list]:
+        """
+        Decides how to get the tx info of a block: skip it, download it
+        per transaction or download the whole block's info.
+        """
+        if "transactions" not in block:
+            return "skipped", []
 
-    def notify_shkeeper(self, symbol, txid):
+        txids = get_contract_call_txids(block)
+        if not txids:
+            mode = "skipped"
+            logger.debug(f"Block {block_num}: No relevant contract calls")
+        elif len(txids) <= config.BLOCK_SCANNER_TX_INFO_BY_ID_MAX_TXS:
+            mode = "by_id"
+        else:
+            mode = "by_block"
+        metrics.scanner_blocks_tx_info.labels(mode=mode).inc()
+        return mode, txids
+
+    def queue_notification(self, tron_tx: TronTransaction):
         if config.DEVMODE_SKIP_NOTIFICATIONS:
-            logger.info(f"[DEVMODE] Skipping notification for TXID {txid}")
+            logger.info(f"[DEVMODE] Skipping notification for TXID {tron_tx.txid}")
             return
+        self.block_notifications.append(tron_tx)
+
+    def queue_action(self, action: str, tron_tx: TronTransaction):
+        """
+        Queues an action on the transfer to the action outbox, see
+        app.actions.run_action() for the actions.
+        """
+        self.block_actions.append((action, tron_tx))
 
-        url = f"http://{config.SHKEEPER_HOST}/api/v1/walletnotify/{symbol}/{txid}"
-        headers = {"X-Shkeeper-Backend-Key": config.SHKEEPER_BACKEND_KEY}
-        res = requests.post(url, headers=headers).json()
-        logger.info(f"Shkeeper response: {res}")
-        if res["status"] != "success":
-            raise NotificationFailed(res)
-
-    def scan(self, block_num: int) -> bool:
-        from .tasks import transfer_trc20_from, transfer_trx_from
-        from .custom.aml.functions import (
-            add_transaction_to_db,
+    def is_processed_transfer(self, tron_tx: TronTransaction) -> bool:
+        key = (tron_tx.txid, tron_tx.log_index)
+        if key in self.pending_transfers:
+            return True
+        return bool(
+            query_db2(
+                "SELECT 1 FROM processed_transfers WHERE txid = ? AND log_index = ?",
+                key,
+                one=True,
+            )
         )
-        from .custom.aml.tasks import run_payout_for_tx
 
+    def record_stage_time(self, stage: str, seconds: float):
+        """
+        Called with the time spent on a block in a scanner stage (download,
+        match, parse, notify).
+        """
+        metrics.scanner_stage_seconds.labels(stage=stage).observe(seconds)
+
+    def scan(
+        self,
+        block_num: int,
+        block: dict,
+        block_tx_info: dict,
+        result: "MatchResult | None" = None,
+    ) -> bool:
+        """
+        Handles transfers of the block. `result` is the block already matched
+        by a match worker, `block` and `block_tx_info` are unused then.
+        """
         try:
-            block = self.download_block(block_num)
-            if "transactions" not in block:
+            if result is None and "transactions" not in block:
                 logger.debug(f"Block {block_num}: No transactions")
                 return True
 
-            block_tx_info = self.download_tx_info_by_block_num(block_num)
-
             start = time.time()
+            self.block_notifications = []
+            self.block_transfers = []
+            self.block_actions = []
             valid_addresses = self.get_watched_accounts()
+            if result is None:
+                result = match_block(
+                    block_num, block, block_tx_info, self.get_watched_accounts_hex()
+                )
+            self.record_stage_time("match", result.match_time)
+            self.record_stage_time("parse", result.parse_time)
 
-            txs = block["transactions"]
-            for tx in txs:
-                try:
-                    tx_info = block_tx_info.get(tx["txID"], {})
-                    tron_tx_list = parse_tx(tx, tx_info)
-                    logger.debug(f"Block {block_num}: Found {tron_tx_list=}")
-
-                except (
-                    UnknownTransactionType,
-                    InsufficientDataBytes,
-                    BadContractResult,
-                ) as e:
-                    logger.debug(f"Can't get info from tx: {e}: {tx}")
-                    continue
-
-                except NonEmptyPaddingBytes as e:
-                    logger.warning(f"Can't decode tx data: {e}: {tx}")
-                    continue
-
-                except Exception as e:
-                    logger.warning(
-                        f"Block {block_num}: Transaction info extraction error: {e}: {tx}"
-                    )
-                    raise e
-
-                for tron_tx in tron_tx_list:
-                    if config.EXTERNAL_DRAIN_CONFIG:
-                        #
-                        # Customized workflow (AML)
-                        #
-                        if tron_tx.dst_addr not in valid_addresses:
-                            continue
-                        if tron_tx.status != "SUCCESS":
-                            logger.warning(
-                                f"Skipping notification for bad status TX {tron_tx=}"
-                            )
-                            continue
-                        logger.info(f"Sending notification for TX {tron_tx=}")
-                        self.notify_shkeeper(tron_tx.symbol.value, tron_tx.txid)
-                        if (
-                            self.main_account
-                            not in (tron_tx.src_addr, tron_tx.dst_addr)
-                            and tron_tx.dst_addr in valid_addresses
-                            and tron_tx.src_addr not in valid_addresses
-                        ):  # to one-time from foreign
-                            add_transaction_to_db(
-                                tron_tx.txid,
-                                tron_tx.dst_addr,
-                                tron_tx.amount,
-                                tron_tx.symbol,
-                            )
-                            run_payout_for_tx.apply_async(
-                                args=[
-                                    tron_tx.symbol,
-                                    tron_tx.dst_addr,
-                                    tron_tx.txid,
-                                ],
-                                # wait for 5min for data to be updated in AMLBot
-                                countdown=config.AML_WAIT_BEFORE_API_CALL,
-                            )
+            notify_start = time.perf_counter()
+            for tron_tx in result.transfers:
+                if tron_tx.dst_addr in valid_addresses:
+                    # the block was scanned before, don't notify or sweep twice
+                    if self.is_processed_transfer(tron_tx):
+                        logger.info(
+                            f"Skipping already processed transfer {tron_tx.txid}:{tron_tx.log_index}"
+                        )
+                        continue
+                    self.block_transfers.append(tron_tx)
+                    metrics.scanner_matched_transfers.labels(
+                        symbol=tron_tx.symbol.value
+                    ).inc()
+                self.handle_transfer(tron_tx, valid_addresses)
+            self.record_stage_time("notify", time.perf_counter() - notify_start)
+            # delivered by NotificationDispatcher once the block is committed
+            self.pending_notifications.extend(self.block_notifications)
+            self.pending_transfers.update(
+                {(t.txid, t.log_index): block_num for t in self.block_transfers}
+            )
+            self.pending_actions.extend(self.block_actions)
 
-                        elif (
-                            tron_tx.dst_addr in valid_addresses
-                            and tron_tx.src_addr == self.main_account
-                        ):  # to one-time from fee-deposit
-                            add_transaction_to_db(
-                                tron_tx.txid,
-                                tron_tx.dst_addr,
-                                tron_tx.amount,
-                                tron_tx.symbol,
-                                "from_fee",
-                            )
-                        else:
-                            raise Exception("")
-                    else:
-                        #
-                        # Default workflow
-                        #
-                        if (
-                            tron_tx.symbol == "TRX"
-                            and tron_tx.src_addr == self.main_account
-                            and tron_tx.dst_addr in valid_addresses
-                        ):
-                            logger.info(
-                                f"Ignoring TRX transaction from main to onetime acc: {tron_tx}"
-                            )
-                            continue
-
-                        if tron_tx.dst_addr in valid_addresses:
-                            if tron_tx.status == "SUCCESS":
-                                logger.info(f"Sending notification for {tron_tx}")
-                                self.notify_shkeeper(tron_tx.symbol.value, tron_tx.txid)
-                                # Send funds to main account
-                                if tron_tx.is_trc20:
-                                    if config.DEVMODE_CELERY_NODELAY:
-                                        transfer_trc20_from(
-                                            tron_tx.dst_addr, tron_tx.symbol
-                                        )
-                                    else:
-                                        transfer_trc20_from.delay(
-                                            tron_tx.dst_addr, tron_tx.symbol
-                                        )
-                                else:
-                                    if config.ENERGY_DELEGATION_MODE:
-                                        # Don't send TRX immediately to not waste free bandwidth.
-                                        # Funds will be sweeped by scan_accounts task
-                                        # if the account does not hold TRC20 tokens.
-                                        pass
-                                    else:
-                                        transfer_trx_from.delay(tron_tx.dst_addr)
-                            else:
-                                logger.warning(
-                                    f"Not sending notification for tx with status {tron_tx.status}: {tron_tx}"
-                                )
+            logger.debug(
+                f"Block {block_num}: {result.skipped_txs} of {result.txs} transactions skipped by prefilter"
+            )
             logger.debug(
                 f"block {block_num} info extraction time: {time.time() - start}"
             )
@@ -317,6 +790,310 @@ class BlockScanner:
 
         return True
 
+    def handle_transfer(self, tron_tx: TronTransaction, valid_addresses):
+        if config.EXTERNAL_DRAIN_CONFIG:
+            #
+            # Customized workflow (AML)
+            #
+            if tron_tx.dst_addr not in valid_addresses:
+                return
+            if tron_tx.status != "SUCCESS":
+                logger.warning(f"Skipping notification for bad status TX {tron_tx=}")
+                return
+            logger.info(f"Sending notification for TX {tron_tx=}")
+            self.queue_notification(tron_tx)
+            if (
+                self.main_account not in (tron_tx.src_addr, tron_tx.dst_addr)
+                and tron_tx.dst_addr in valid_addresses
+                and tron_tx.src_addr not in valid_addresses
+            ):  # to one-time from foreign
+                self.queue_action("aml_add_transaction", tron_tx)
+                self.queue_action("aml_payout", tron_tx)
+
+            elif (
+                tron_tx.dst_addr in valid_addresses
+                and tron_tx.src_addr == self.main_account
+            ):  # to one-time from fee-deposit
+                self.queue_action("aml_add_fee_transaction", tron_tx)
+            else:
+                raise Exception("")
+        else:
+            #
+            # Default workflow
+            #
+            if (
+                tron_tx.symbol == "TRX"
+                and tron_tx.src_addr == self.main_account
+                and tron_tx.dst_addr in valid_addresses
+            ):
+                logger.info(
+                    f"Ignoring TRX transaction from main to onetime acc: {tron_tx}"
+                )
+                return
+
+            if tron_tx.dst_addr in valid_addresses:
+                if tron_tx.status == "SUCCESS":
+                    logger.info(f"Sending notification for {tron_tx}")
+                    self.queue_notification(tron_tx)
+                    # Send funds to main account
+                    if tron_tx.is_trc20:
+                        self.queue_action("transfer_trc20", tron_tx)
+                    else:
+                        if config.ENERGY_DELEGATION_MODE:
+                            # Don't send TRX immediately to not waste free bandwidth.
+                            # Funds will be sweeped by scan_accounts task
+                            # if the account does not hold TRC20 tokens.
+                            pass
+                        else:
+                            self.queue_action("transfer_trx", tron_tx)
+                else:
+                    logger.warning(
+                        f"Not sending notification for tx with status {tron_tx.status}: {tron_tx}"
+                    )
+
+
+class ScanProgress:
+    """
+    Keeps track of scanned blocks above the watermark (last_seen_block_num),
+    which only moves over a contiguous range of scanned blocks. Blocks
+    scanned past a failed one are stored in the scanned_blocks table on
+    commit, so they are not scanned again when the failed block is retried
+    or the scanner restarts. At most BLOCK_SCANNER_MAX_SCAN_AHEAD blocks are
+    scanned past the watermark.
+    """
+
+    def __init__(self, last_seen: int, scanned_blocks: list):
+        self.last_seen = last_seen
+        self.scanned = set(scanned_blocks)
+        self.uncommitted = set()
+        self.retry_at = {}
+        self.advance()
+
+    def is_scanned(self, block_num: int) -> bool:
+        return block_num <= self.last_seen or block_num in self.scanned
+
+    def can_scan(self, block_num: int) -> bool:
+        return block_num - self.last_seen <= config.BLOCK_SCANNER_MAX_SCAN_AHEAD
+
+    def mark_scanned(self, block_num: int):
+        self.scanned.add(block_num)
+        self.uncommitted.add(block_num)
+        self.advance()
+
+    def mark_failed(self, block_num: int):
+        metrics.scanner_block_retries.inc()
+        self.retry_at[block_num] = time.time() + config.BLOCK_SCANNER_RETRY_PERIOD
+
+    def pop_due_retries(self) -> list:
+        now = time.time()
+        due = sorted(n for n, retry_at in self.retry_at.items() if retry_at <= now)
+        for block_num in due:
+            del self.retry_at[block_num]
+        return due
+
+    def advance(self):
+        while self.last_seen + 1 in self.scanned:
+            self.last_seen += 1
+            self.scanned.remove(self.last_seen)
+
+    def get_uncommitted(self) -> list:
+        """Returns uncommitted scanned blocks above the watermark."""
+        return sorted(n for n in self.uncommitted if n > self.last_seen)
+
+
+@dataclass
+class MatchResult:
+    transfers: List[TronTransaction] = field(default_factory=list)
+    txs: int = 0
+    skipped_txs: int = 0
+    match_time: float = 0
+    parse_time: float = 0
+
+
+def match_block(
+    block_num: int, block: dict, block_tx_info: dict, watched_accounts_hex
+) -> MatchResult:
+    """
+    Returns transfers of the block's transactions that passed the
+    is_relevant_tx() prefilter, parsed with parse_tx().
+    """
+    result = MatchResult(txs=len(block["transactions"]))
+    for tx in block["transactions"]:
+        match_start = time.perf_counter()
+        tx_info = block_tx_info.get(tx["txID"], {})
+        is_relevant = is_relevant_tx(tx, tx_info, watched_accounts_hex)
+        parse_start = time.perf_counter()
+        result.match_time += parse_start - match_start
+        if not is_relevant:
+            result.skipped_txs += 1
+            continue
+
+        try:
+            tron_tx_list = parse_tx(tx, tx_info)
+            logger.debug(f"Block {block_num}: Found {tron_tx_list=}")
+
+        except (
+            UnknownTransactionType,
+            InsufficientDataBytes,
+            BadContractResult,
+        ) as e:
+            logger.debug(f"Can't get info from tx: {e}: {tx}")
+            continue
+
+        except NonEmptyPaddingBytes as e:
+            logger.warning(f"Can't decode tx data: {e}: {tx}")
+            continue
+
+        except Exception as e:
+            logger.warning(
+                f"Block {block_num}: Transaction info extraction error: {e}: {tx}"
+            )
+            raise e
+
+        finally:
+            result.parse_time += time.perf_counter() - parse_start
+
+        for tron_tx in tron_tx_list:
+            tron_tx.block_num = block_num
+        result.transfers.extend(tron_tx_list)
+    return result
+
+
+def record_response(method: str, seconds: float, size: int):
+    metrics.scanner_downloaded_bytes.labels(method=method).inc(size)
+    metrics.scanner_request_seconds.labels(method=method).observe(seconds)
+    metrics.scanner_response_bytes.labels(method=method).observe(size)
+
+
+# watched accounts snapshot of a match worker process
+worker_watched_accounts_hex = None
+
+
+def init_match_worker(watched_accounts_hex: AddressSet):
+    global worker_watched_accounts_hex
+    worker_watched_accounts_hex = watched_accounts_hex
+
+
+def match_raw_block(
+    block_num: int, raw_block: bytes, raw_tx_info: bytes, added_accounts_hex: tuple
+) -> MatchResult:
+    """
+    Decodes and matches a block in a match worker process. Only the matched
+    transfers are sent back to the scanner process.
+    """
+    worker_watched_accounts_hex.update(added_accounts_hex)
+    block = json_decoder.loads(raw_block, "wallet/getblockbynum")
+    check_block_found(block_num, block)
+    if "transactions" not in block:
+        return MatchResult()
+    block_tx_info = tx_info_by_id(
+        json_decoder.loads(raw_tx_info, "wallet/gettransactioninfobyblocknum")
+    )
+    return match_block(block_num, block, block_tx_info, worker_watched_accounts_hex)
+
+
+def to_raw_hex_address(address: str) -> str:
+    """Converts base58 or hex Tron address to 20-byte hex without 0x41 prefix."""
+    if address.startswith("T"):
+        address = to_hex_address(address)
+    return address[-40:].lower()
+
+
+def to_base58_address(address: str) -> str:
+    """Converts hex Tron address (with or without 0x41 prefix) to base58."""
+    if address.startswith("T"):
+        return address
+    return to_base58check_address("41" + address[-40:])
+
+
+def check_block_found(block_num: int, block: dict):
+    if not block:
+        raise BlockNotFound(f"Block {block_num} not found")
+
+
+def blocks_by_num(result: dict) -> dict:
+    return {
+        block["block_header"]["raw_data"]["number"]: block
+        for block in result.get("block", [])
+    }
+
+
+def tx_info_by_id(transaction_results: list) -> dict:
+    return {result["id"]: result for result in transaction_results if "log" in result}
+
+
+@functools.cache
+def get_token_contract_addresses() -> frozenset:
+    return frozenset(
+        to_raw_hex_address(token.contract_address) for token in config.get_tokens()
+    )
+
+
+def get_contract_call_txids(block: dict) -> list:
+    """
+    Returns IDs of successful smart contract calls whose logs can contain
+    token transfers. Transfers can also be emitted by token contracts called
+    from other contracts (routers, batch payout contracts, etc.), so unless
+    BLOCK_SCANNER_SKIP_INDIRECT_TOKEN_TRANSFERS is set all contract calls
+    are returned, not only direct calls to the token contracts.
+    """
+    token_contracts = get_token_contract_addresses()
+    txids = []
+    for tx in block["transactions"]:
+        try:
+            contract = tx["raw_data"]["contract"][0]
+            if (
+                contract["type"] != "TriggerSmartContract"
+                or tx["ret"][0]["contractRet"] != "SUCCESS"
+            ):
+                continue
+            if (
+                config.BLOCK_SCANNER_SKIP_INDIRECT_TOKEN_TRANSFERS
+                and contract["parameter"]["value"]["contract_address"][-40:]
+                not in token_contracts
+            ):
+                continue
+        except (KeyError, IndexError, TypeError):
+            pass
+        txids.append(tx["txID"])
+    return txids
+
+
+def is_relevant_tx(tx: dict, transaction_info: dict, watched_accounts_hex) -> bool:
+    """
+    Cheap check if parse_tx() can produce a transfer to one of the watched
+    accounts. Only destination addresses are looked at, the scanner ignores
+    transfers whose destination is not watched. Expects the transaction and
+    its info in visible=False form, so addresses are compared as hex strings
+    without base58 encoding. Transactions of unexpected shape are passed
+    through so parse_tx() can handle them as before.
+    """
+    try:
+        if tx["ret"][0]["contractRet"] != "SUCCESS":
+            return False
+
+        contract = tx["raw_data"]["contract"][0]
+        if contract["type"] == "TransferContract":
+            to_address = contract["parameter"]["value"]["to_address"]
+            return to_address[-40:] in watched_accounts_hex
+
+        if contract["type"] == "TriggerSmartContract":
+            token_contracts = get_token_contract_addresses()
+            for entry in transaction_info.get("log", []):
+                topics = entry["topics"]
+                if (
+                    len(topics) != 3
+                    or topics[0] != TRANSFER_EVENT
+                    or entry["address"][-40:] not in token_contracts
+                ):
+                    continue
+                if topics[2][-40:] in watched_accounts_hex:
+                    return True
+
+        return False
+    except (KeyError, IndexError, TypeError):
+        return True
+
 
 def parse_tx(tx: dict, transaction_info) -> List[TronTransaction]:
     transactions = []
@@ -330,8 +1107,12 @@ def parse_tx(tx: dict, transaction_info) -> List[TronTransaction]:
 
     if tx_type == "TransferContract":
         symbol = "TRX"
-        from_addr = tx["raw_data"]["contract"][0]["parameter"]["value"]["owner_address"]
-        to_addr = tx["raw_data"]["contract"][0]["parameter"]["value"]["to_address"]
+        from_addr = to_base58_address(
+            tx["raw_data"]["contract"][0]["parameter"]["value"]["owner_address"]
+        )
+        to_addr = to_base58_address(
+            tx["raw_data"]["contract"][0]["parameter"]["value"]["to_address"]
+        )
         amount = Decimal(
             tx["raw_data"]["contract"][0]["parameter"]["value"]["amount"]
         ) / Decimal(1_000_000)
@@ -354,21 +1135,15 @@ def parse_tx(tx: dict, transaction_info) -> List[TronTransaction]:
         if "log" not in transaction_info:
             raise UnknownTransactionType(f"Transaction {txid} produced no logs")
 
-        for entry in transaction_info["log"]:
+        for log_index, entry in enumerate(transaction_info["log"]):
             try:
-                log_entry_producer_address = entry["address"]
+                log_entry_producer_address = to_base58_address(entry["address"])
                 symbol = config.get_symbol(log_entry_producer_address)
             except UnknownToken:
                 continue
 
-            # >>> from tronpy.contract import keccak256
-            # >>> bytes.hex(keccak256("Transfer(address,address,uint256)".encode()))
-            # 'ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
-            transfer_event = (
-                "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
-            )
             event = entry["topics"][0]
-            if event != transfer_event:
+            if event != TRANSFER_EVENT:
                 continue
 
             _, hex_from_addr, hex_to_addr = entry["topics"]
@@ -395,6 +1170,7 @@ def parse_tx(tx: dict, transaction_info) -> List[TronTransaction]:
                     dst_addr=to_addr,
                     amount=amount,
                     is_trc20=is_trc20,
+                    log_index=log_index,
                 )
             )
     else:
@@ -1,6 +1,6 @@
 from decimal import Decimal
 from functools import cache
-from typing import List
+from typing import List, Literal
 
 from pydantic import Field, Json, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -30,6 +30,10 @@ class Settings(BaseSettings):
     TRON_NODE_USERNAME: str = "shkeeper"
     TRON_NODE_PASSWORD: str = "tron"
     TRON_CLIENT_TIMEOUT: int = 10
+    TRON_CLIENT_POOL_SIZE: int = 100
+    TRON_CLIENT_POOL_BLOCK: bool = False  # wait for a free connection
+    TRON_CLIENT_KEEP_ALIVE: bool = True
+    TRON_CLIENT_MAX_RETRIES: int = 3
     API_USERNAME: str = Field("shkeeper", alias="BTC_USERNAME")
     API_PASSWORD: str = Field("shkeeper", alias="BTC_PASSWORD")
     SHKEEPER_BACKEND_KEY: str = "shkeeper"
@@ -47,12 +51,59 @@ class Settings(BaseSettings):
     TRX_MIN_TRANSFER_THRESHOLD: Decimal = Decimal("0.5")
     # Block scanner
     BLOCK_SCANNER_STATS_LOG_PERIOD: int = 300
+    BLOCK_SCANNER_ENGINE: Literal["thread", "asyncio"] = "thread"
+    BLOCK_SCANNER_ASYNC_CONCURRENCY: int = 100
     BLOCK_SCANNER_MAX_BLOCK_CHUNK_SIZE: int = 1
+    BLOCK_SCANNER_PREFETCH_SIZE: int = 10
+    BLOCK_SCANNER_BLOCK_BATCH_SIZE: int = 1  # >1 enables getblockbylimitnext
+    BLOCK_SCANNER_ADAPTIVE: bool = True
+    BLOCK_SCANNER_MIN_FETCH_CONCURRENCY: int = 1
+    BLOCK_SCANNER_MAX_FETCH_CONCURRENCY: int = 32
+    BLOCK_SCANNER_MAX_COMMIT_BATCH_SIZE: int = 50
+    BLOCK_SCANNER_ADAPTIVE_TARGET_LATENCY: float = 2.0
+    BLOCK_SCANNER_ADAPTIVE_MAX_ERROR_RATE: float = 0.1
+    BLOCK_SCANNER_TX_INFO_BY_ID_MAX_TXS: int = 5
+    BLOCK_SCANNER_SKIP_INDIRECT_TOKEN_TRANSFERS: bool = False
+    BLOCK_SCANNER_CATCHUP_PROCESSES: int = 0  # >0 enables match worker processes
+    BLOCK_SCANNER_CATCHUP_MIN_LAG: int = 1000
     BLOCK_SCANNER_INTERVAL_TIME: int = 3
+    BLOCK_SCANNER_EMBEDDED: bool = True  # run the scanner in the API process
+    BLOCK_SCANNER_METRICS_PORT: int | None = None  # for scanner.py
+    LEADER_LEASE_TTL: int = 30
+    WATCHED_ACCOUNTS_FILE: str | None = None  # memory-mapped watched accounts prefix
+    WATCHED_ACCOUNTS_SYNC_PERIOD: float = 1
+    JSON_DECODER: Literal["auto", "msgspec", "orjson", "json"] = "auto"
+    BLOCK_SCANNER_RETRY_PERIOD: int = 5
+    BLOCK_SCANNER_MAX_SCAN_AHEAD: int = 1000  # blocks scanned past a failed one
+    BLOCK_SCANNER_PROCESSED_TRANSFERS_MARGIN: int = 1000  # blocks below watermark
     BLOCK_SCANNER_LAST_BLOCK_NUM_HINT: int | None = None
+    BLOCK_CACHE_DATABASE: str = "data/block_cache.db"
+    BLOCK_CACHE_MAX_ENTRIES: int = 200  # 0 disables the cache
+    BLOCK_CACHE_WRITE_QUEUE_SIZE: int = 100
+    # Notifications
+    NOTIFICATION_DISPATCHER_CONCURRENCY: int = 4
+    NOTIFICATION_DISPATCHER_POLL_PERIOD: float = 1
+    NOTIFICATION_TIMEOUT: int = 10
+    NOTIFICATION_RETRY_INITIAL_DELAY: int = 5
+    NOTIFICATION_RETRY_MAX_DELAY: int = 600
+    NOTIFICATION_BATCH_MODE: bool = False
+    NOTIFICATION_BATCH_WINDOW: float = 3
+    NOTIFICATION_BATCH_MAX_SIZE: int = 100
+    # Java-tron event plugin (native ZeroMQ queue)
+    EVENT_LISTENER_ENABLED: bool = False
+    EVENT_LISTENER_ZMQ_URL: str = "tcp://127.0.0.1:5555"
+    EVENT_LISTENER_POLL_DELAY: int = 20  # blocks behind the head to fill gaps
+    EVENT_LISTENER_QUEUE_SIZE: int = 100  # received blocks waiting for the scanner
     # Connection manager
     MULTISERVER_CONFIG_JSON: Json[List[TronFullnode]] | None = None
     MULTISERVER_REFRESH_BEST_SERVER_PERIOD: int = 20
+    MULTISERVER_PROBE_TIMEOUT: float = 5
+    MULTISERVER_MAX_BLOCK_LAG: int = 2
+    MULTISERVER_HEDGE_REQUESTS: bool = False
+    MULTISERVER_SPREAD_DOWNLOADS: bool = True
+    MULTISERVER_DOWNLOAD_ERROR_BAN_PERIOD: int = 60
+    CURRENT_SERVER_VERSION_FILE: str = "data/current_server_id.version"
+    CURRENT_SERVER_CHECK_PERIOD: float = 1
     # Account encryption
     FORCE_WALLET_ENCRYPTION: bool = False
     # DEV MODE
@@ -1,18 +1,133 @@
+import collections
 import datetime
 import json
+import os
+import pathlib
+import random
+import threading
 import time
-from urllib.parse import urlparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlparse
 
+import prometheus_client
 import requests
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from urllib3.util.retry import Retry
 
 from tronpy import Tron
 from tronpy.providers import HTTPProvider
 
+from . import json_decoder, metrics
 from .config import TronFullnode, config
 from .db import query_db2
 from .logging import logger
 from .exceptions import AllServersOffline, NoServerSet
 
+EWMA_ALPHA = 0.2
+# the current server is kept unless the best one is faster by that factor
+SERVER_SWITCH_LATENCY_RATIO = 1.2
+# idempotent fullnode API methods which may be hedged
+HEDGE_METHOD_PREFIXES = (
+    "wallet/get",
+    "walletsolidity/get",
+    "wallet/triggerconstantcontract",
+)
+# response times kept per server to estimate the hedge delay
+HEDGE_LATENCY_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+def ewma(previous: float | None, value: float) -> float:
+    if previous is None:
+        return value
+    return previous * (1 - EWMA_ALPHA) + value * EWMA_ALPHA
+
+
+class FastHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider which decodes responses with json_decoder. Responses are
+    not decoded to typed dicts, Tron client users may read any field.
+    """
+
+    def make_request(self, method: str, params: dict | None = None) -> dict:
+        if params is None:
+            params = {}
+        resp = self.sess.post(
+            urljoin(self.endpoint_uri, method), json=params, timeout=self.timeout
+        )
+        resp.raise_for_status()
+        return json_decoder.loads(resp.content)
+
+
+class HedgedHTTPProvider(FastHTTPProvider):
+    """
+    FastHTTPProvider which hedges idempotent requests. If the server has not
+    answered within the 95th percentile of its recent response times, the
+    request is sent to the fastest other up-to-date server as well and the
+    first response wins.
+    """
+
+    def __init__(self, *args, manager: "ConnectionManager", server_id: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manager = manager
+        self.server_id = server_id
+        self.latencies = collections.deque(maxlen=HEDGE_LATENCY_SAMPLES)
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.TRON_CLIENT_POOL_SIZE * 2,
+            thread_name_prefix="Hedged request",
+        )
+
+    def get_hedge_delay(self) -> float | None:
+        latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(len(latencies) * 0.95)]
+
+    def send_request(self, method: str, params: dict | None = None) -> dict:
+        start_time = time.perf_counter()
+        result = super().make_request(method, params)
+        self.latencies.append(time.perf_counter() - start_time)
+        return result
+
+    def make_request(self, method: str, params: dict | None = None) -> dict:
+        if not method.startswith(HEDGE_METHOD_PREFIXES):
+            return self.send_request(method, params)
+        metrics.client_hedge_eligible_requests.inc()
+        delay = self.get_hedge_delay()
+        if delay is None:
+            return self.send_request(method, params)
+
+        primary = self.executor.submit(self.send_request, method, params)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        hedge_server_id = self.manager.get_hedge_server_id(self.server_id)
+        if hedge_server_id is None:
+            return primary.result()
+        hedge_provider = self.manager.get_client_for_server_id(
+            hedge_server_id
+        ).provider
+        # sent without hedging it again
+        hedge = self.executor.submit(
+            FastHTTPProvider.make_request, hedge_provider, method, params
+        )
+        metrics.client_hedged_requests.inc()
+        logger.debug(
+            f"Request {method} to server {self.server_id} is hedged "
+            f"to server {hedge_server_id} after {delay:.3f}s"
+        )
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.client_hedge_wins.inc()
+                    return future.result()
+        # both failed
+        return primary.result()
+
 
 class ConnectionManager:
     instance = None
@@ -45,6 +160,33 @@ class ConnectionManager:
             raise Exception(
                 "No FULLNODE_URL or MULTISERVER_CONFIG_JSON env variables are set!"
             )
+        # block heights of online servers from the last status check
+        self.server_heights = {}
+        # solidified block heights of online servers from the last status check
+        self.server_solid_heights = {}
+        # last status of the servers, see get_servers_status()
+        self.servers_status = []
+        self.servers_status_updated_at = None
+        self.servers_status_lock = threading.Lock()
+        self.probe_executor = ThreadPoolExecutor(
+            max_workers=len(self.servers), thread_name_prefix="Server probe"
+        )
+        # per server download latency EWMA and error ban deadline
+        self.download_latency = {}
+        self.download_banned_until = {}
+        # per server request latency and error rate EWMA
+        self.server_latency = {}
+        self.server_error_rate = {}
+        self.server_stats_lock = threading.Lock()
+        # long-lived clients with their connection pools by server ID
+        self.clients = {}
+        self.clients_pid = os.getpid()
+        self.clients_lock = threading.Lock()
+        prometheus_client.REGISTRY.register(ClientPoolCollector(self))
+        # current server ID cached in memory, see get_current_server_id()
+        self.current_server_id = None
+        self.current_server_version = None
+        self.current_server_next_check = 0
 
     def get_client(self) -> Tron:
         server_id = self.get_current_server_id()
@@ -54,15 +196,87 @@ class ConnectionManager:
         return client
 
     def get_client_for_server_id(self, server_id) -> Tron:
-        provider = HTTPProvider(
-            self.servers[server_id].url, timeout=config.TRON_CLIENT_TIMEOUT
+        with self.clients_lock:
+            if self.clients_pid != os.getpid():
+                # forked (Celery worker), don't share parent's connections
+                self.clients = {}
+                self.clients_pid = os.getpid()
+            if server_id not in self.clients:
+                self.clients[server_id] = self.create_client(server_id)
+            return self.clients[server_id]
+
+    def create_client(self, server_id) -> Tron:
+        if config.MULTISERVER_HEDGE_REQUESTS and len(self.servers) > 1:
+            provider = HedgedHTTPProvider(
+                self.servers[server_id].url,
+                timeout=config.TRON_CLIENT_TIMEOUT,
+                manager=self,
+                server_id=server_id,
+            )
+        else:
+            provider = FastHTTPProvider(
+                self.servers[server_id].url, timeout=config.TRON_CLIENT_TIMEOUT
+            )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=config.TRON_CLIENT_POOL_SIZE,
+            pool_block=config.TRON_CLIENT_POOL_BLOCK,
+            # only failed connection attempts are retried, a request which
+            # reached the node may have been executed
+            max_retries=Retry(
+                total=config.TRON_CLIENT_MAX_RETRIES,
+                read=0,
+                status=0,
+                backoff_factor=0.1,
+            ),
         )
-        adapter = requests.adapters.HTTPAdapter(pool_maxsize=100)
         provider.sess.mount("http://", adapter)
         provider.sess.mount("https://", adapter)
+        if not config.TRON_CLIENT_KEEP_ALIVE:
+            provider.sess.headers["Connection"] = "close"
         return Tron(provider)
 
+    def get_pool_stats(self) -> dict:
+        """Returns connection pool stats of the clients by server name."""
+        with self.clients_lock:
+            clients = dict(self.clients)
+        stats = {}
+        for server_id, client in clients.items():
+            server_stats = {"opened": 0, "requests": 0, "in_use": 0, "size": 0}
+            adapter = client.provider.sess.get_adapter(self.servers[server_id].url)
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None or pool.pool is None:  # closed
+                    continue
+                server_stats["opened"] += pool.num_connections
+                server_stats["requests"] += pool.num_requests
+                # the pool queue holds idle connections and free slots
+                server_stats["in_use"] += pool.pool.maxsize - pool.pool.qsize()
+                server_stats["size"] += pool.pool.maxsize
+            stats[self.servers[server_id].name] = server_stats
+        return stats
+
     def get_current_server_id(self):
+        """
+        Returns the current server ID kept in memory. Processes changing it
+        touch CURRENT_SERVER_VERSION_FILE, its mtime is checked at most once
+        per CURRENT_SERVER_CHECK_PERIOD and the ID is reloaded from the
+        database only when the file has changed.
+        """
+        now = time.monotonic()
+        if now < self.current_server_next_check:
+            return self.current_server_id
+        self.current_server_next_check = now + config.CURRENT_SERVER_CHECK_PERIOD
+        try:
+            version = os.stat(config.CURRENT_SERVER_VERSION_FILE).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        if version != self.current_server_version or self.current_server_id is None:
+            self.current_server_version = version
+            self.current_server_id = self.load_current_server_id()
+        return self.current_server_id
+
+    def load_current_server_id(self):
         row = query_db2(
             'SELECT value FROM settings WHERE name = "current_server_id"', one=True
         )
@@ -74,67 +288,199 @@ class ConnectionManager:
 
     def set_current_server_id(self, server_id):
         query_db2(
-            'UPDATE settings SET value = ? WHERE name = "current_server_id"',
+            'INSERT INTO settings VALUES ("current_server_id", ?) '
+            "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
             (server_id,),
         )
+        self.current_server_id = server_id
+        pathlib.Path(config.CURRENT_SERVER_VERSION_FILE).touch()
         logger.debug(f"Current server ID is set to: {server_id}")
 
     def get_servers_status(self):
-        servers_status = []
-        for server_id, server in enumerate(self.servers):
-            try:
-                # node info
-                resp = requests.get(f"{server.url}/wallet/getnodeinfo")
-                resp.raise_for_status()
-                node_info = resp.json()
-
-                # remove unneeded info
-                del node_info["peerList"]
-                del node_info["machineInfo"]["memoryDescInfoList"]
-
-                # convert "Num:XXX,ID:YYY" to XXX
-                node_info["block"] = int(
-                    [j for i in node_info["block"].split(",") for j in i.split(":")][1]
+        """
+        Returns the last status of the servers. The status is updated by
+        refresh_best_server_thread_handler() every
+        MULTISERVER_REFRESH_BEST_SERVER_PERIOD. Processes not running it (the
+        API with a standalone scanner) probe the servers here once the status
+        is older than two periods.
+        """
+        with self.servers_status_lock:
+            updated_at = self.servers_status_updated_at
+            if (
+                updated_at is None
+                or time.monotonic() - updated_at
+                > 2 * config.MULTISERVER_REFRESH_BEST_SERVER_PERIOD
+            ):
+                self.update_servers_status()
+            servers_status = self.servers_status
+        current_server_id = self.get_current_server_id()
+        with self.server_stats_lock:
+            return [
+                {
+                    **status,
+                    "is_active": status["id"] == current_server_id,
+                    "latency": self.server_latency.get(status["id"]),
+                    "error_rate": self.server_error_rate.get(status["id"], 0),
+                }
+                for status in servers_status
+            ]
+
+    def update_servers_status(self):
+        """
+        Probes all servers concurrently. Each probe makes two requests bound
+        by MULTISERVER_PROBE_TIMEOUT.
+        """
+        servers_status = list(
+            self.probe_executor.map(self.probe_server, range(len(self.servers)))
+        )
+        self.servers_status = servers_status
+        self.servers_status_updated_at = time.monotonic()
+        self.server_heights = {
+            status["id"]: status["node_info"]["block"]
+            for status in servers_status
+            if status["status"] == "success"
+        }
+        self.server_solid_heights = {
+            status["id"]: status["node_info"]["solidity_block"]
+            for status in servers_status
+            if status["status"] == "success"
+        }
+
+    def probe_server(self, server_id: int) -> dict:
+        server = self.servers[server_id]
+        timeout = config.MULTISERVER_PROBE_TIMEOUT
+        try:
+            # node info
+            start_time = time.perf_counter()
+            resp = requests.get(f"{server.url}/wallet/getnodeinfo", timeout=timeout)
+            resp.raise_for_status()
+            latency = time.perf_counter() - start_time
+            node_info = json_decoder.loads(resp.content)
+
+            # remove unneeded info
+            del node_info["peerList"]
+            del node_info["machineInfo"]["memoryDescInfoList"]
+
+            # convert "Num:XXX,ID:YYY" to XXX
+            node_info["block"] = int(
+                [j for i in node_info["block"].split(",") for j in i.split(":")][1]
+            )
+            node_info["solidity_block"] = int(
+                [
+                    j
+                    for i in node_info["solidityBlock"].split(",")
+                    for j in i.split(":")
+                ][1]
+            )
+
+            # last block info
+            resp = requests.post(
+                f"{server.url}/wallet/getblockbynum",
+                json={"num": node_info["block"]},
+                timeout=timeout,
+            )
+            resp.raise_for_status()
+            block = json_decoder.loads(resp.content, "wallet/getblockbynum")
+            node_info["block_ts"] = (
+                block["block_header"]["raw_data"]["timestamp"] // 1000
+            )
+
+            # Lag
+            now_ts = int(datetime.datetime.now().timestamp())
+            delta = now_ts - node_info["block_ts"]
+            delta = 0 if delta < 0 else delta
+            node_info["lag"] = str(datetime.timedelta(seconds=delta))
+
+            self.record_request(server_id, latency, True)
+            return {
+                "id": server_id,
+                **server.model_dump(),
+                "status": "success",
+                "node_info": node_info,
+            }
+        except Exception as e:
+            logger.debug(f"Failed to get server {server.url} status: {e}")
+            self.record_request(server_id, None, False)
+            return {
+                "id": server_id,
+                **server.model_dump(),
+                "status": "error",
+                "error": str(e),
+            }
+
+    def get_download_server_id(self, block_num: int) -> int:
+        """
+        Picks a server to download block `block_num` from. Online servers
+        that have the block solidified and had no recent download errors are
+        chosen at random, weighted by their download throughput (inverse
+        latency EWMA). Falls back to the current server.
+
+        Blocks above the solidified height are downloaded from the current
+        server only. Servers may have different blocks at the same height
+        there, a block and its tx info must come from the same one.
+        """
+        server_id = self.get_current_server_id()
+        if server_id is None:
+            raise NoServerSet("Current server is not set.")
+        if not config.MULTISERVER_SPREAD_DOWNLOADS or len(self.servers) == 1:
+            return server_id
+
+        now = time.time()
+        with self.server_stats_lock:
+            candidates = [
+                candidate_id
+                for candidate_id, height in self.server_solid_heights.items()
+                if height >= block_num
+                and self.download_banned_until.get(candidate_id, 0) <= now
+            ]
+            if not candidates:
+                return server_id
+            latencies = [self.download_latency.get(i) for i in candidates]
+        known_latencies = [latency for latency in latencies if latency]
+        default_latency = (
+            sum(known_latencies) / len(known_latencies) if known_latencies else 1
+        )
+        weights = [1 / (latency or default_latency) for latency in latencies]
+        return random.choices(candidates, weights=weights)[0]
+
+    def record_request(self, server_id: int, seconds: float | None, is_success: bool):
+        """
+        Updates the server latency and error rate used to pick the best
+        server. Only latencies of small requests (status probes) are passed,
+        downloads just count towards the error rate.
+        """
+        with self.server_stats_lock:
+            self.server_error_rate[server_id] = ewma(
+                self.server_error_rate.get(server_id), 0 if is_success else 1
+            )
+            if is_success and seconds is not None:
+                self.server_latency[server_id] = ewma(
+                    self.server_latency.get(server_id), seconds
                 )
 
-                # last block info
-                resp = requests.post(
-                    f"{server.url}/wallet/getblockbynum",
-                    json={"num": node_info["block"]},
+    def record_download(self, server_id: int, seconds: float, is_success: bool):
+        self.record_request(server_id, None, is_success)
+        with self.server_stats_lock:
+            if is_success:
+                self.download_latency[server_id] = ewma(
+                    self.download_latency.get(server_id), seconds
                 )
-                resp.raise_for_status()
-                block = resp.json()
-                node_info["block_ts"] = (
-                    block["block_header"]["raw_data"]["timestamp"] // 1000
+            else:
+                self.download_banned_until[server_id] = (
+                    time.time() + config.MULTISERVER_DOWNLOAD_ERROR_BAN_PERIOD
                 )
-
-                # Lag
-                now_ts = int(datetime.datetime.now().timestamp())
-                delta = now_ts - node_info["block_ts"]
-                delta = 0 if delta < 0 else delta
-                node_info["lag"] = str(datetime.timedelta(seconds=delta))
-
-                status = {
-                    "id": server_id,
-                    "is_active": self.get_current_server_id() == server_id,
-                    **server.model_dump(),
-                    "status": "success",
-                    "node_info": node_info,
-                }
-            except Exception as e:
-                logger.debug(f"Failed to get server {server.url} status: {e}")
-                status = {
-                    "id": server_id,
-                    "is_active": self.get_current_server_id() == server_id,
-                    **server.model_dump(),
-                    "status": "error",
-                    "error": str(e),
-                }
-            finally:
-                servers_status.append(status)
-        return servers_status
+        if not is_success:
+            logger.info(
+                f"Server {server_id} is removed from block download rotation "
+                f"for {config.MULTISERVER_DOWNLOAD_ERROR_BAN_PERIOD}s"
+            )
 
     def get_best_server_id(self):
+        """
+        Returns the fastest online server within MULTISERVER_MAX_BLOCK_LAG
+        blocks of the highest one. Latency is divided by the success rate,
+        so servers failing requests rank as slower ones.
+        """
         if len(self.servers) == 1:
             return 0
         servers = self.get_servers_status()
@@ -142,10 +488,57 @@ class ConnectionManager:
         online_servers = list(filter(lambda x: x["status"] == "success", servers))
         if not online_servers:
             raise AllServersOffline("All servers are unreachable!")
-        # get server with max block height
-        server_id = max(online_servers, key=lambda x: x["node_info"]["block"])["id"]
+        max_height = max(server["node_info"]["block"] for server in online_servers)
+        scores = {
+            server["id"]: self.get_server_score(server["id"])
+            for server in online_servers
+            if server["node_info"]["block"]
+            >= max_height - config.MULTISERVER_MAX_BLOCK_LAG
+        }
+        server_id = min(scores, key=scores.get)
+        # don't switch between servers of about the same speed
+        current_server_id = self.get_current_server_id()
+        if (
+            current_server_id in scores
+            and scores[current_server_id]
+            <= scores[server_id] * SERVER_SWITCH_LATENCY_RATIO
+        ):
+            return current_server_id
         return server_id
 
+    def get_server_score(self, server_id: int) -> float:
+        """Returns server latency divided by its success rate, lower is better."""
+        with self.server_stats_lock:
+            latency = self.server_latency.get(server_id) or float("inf")
+            error_rate = self.server_error_rate.get(server_id, 0)
+        return latency / max(0.1, 1 - error_rate)
+
+    def get_hedge_server_id(self, server_id: int) -> int | None:
+        """
+        Returns the best server other than `server_id` to hedge its requests
+        to, out of the online servers not behind it, within
+        MULTISERVER_MAX_BLOCK_LAG blocks of the highest one and without recent
+        download errors.
+        """
+        heights = self.server_heights
+        if not heights:
+            return None
+        min_height = max(
+            max(heights.values()) - config.MULTISERVER_MAX_BLOCK_LAG,
+            heights.get(server_id, 0),
+        )
+        now = time.time()
+        scores = {
+            candidate_id: self.get_server_score(candidate_id)
+            for candidate_id, height in heights.items()
+            if candidate_id != server_id
+            and height >= min_height
+            and self.download_banned_until.get(candidate_id, 0) <= now
+        }
+        if not scores:
+            return None
+        return min(scores, key=scores.get)
+
     def refresh_best_server(self) -> bool:
         best_server_id = self.get_best_server_id()
         if best_server_id != self.get_current_server_id():
@@ -155,24 +548,54 @@ class ConnectionManager:
         return False
 
     def refresh_best_server_thread_handler(self):
-        try:
-            if self.get_current_server_id() is None:
-                while True:
-                    try:
-                        server_id = self.get_best_server_id()
-                        query_db2(
-                            'INSERT INTO settings VALUES ("current_server_id", ?)',
-                            (server_id,),
-                        )
-                        logger.debug(f"Current server set to: {server_id}")
-                        break
-                    except Exception as e:
-                        logger.warning(f"Current server set error: {e}")
-                        time.sleep(config.MULTISERVER_REFRESH_BEST_SERVER_PERIOD)
-
-            while True:
-                self.refresh_best_server()
-        except Exception as e:
-            logger.warning(f"Exception in best server refresh loop: {e}")
-        finally:
+        """
+        Probes the servers every MULTISERVER_REFRESH_BEST_SERVER_PERIOD and
+        switches to the best one.
+        """
+        while True:
+            try:
+                with self.servers_status_lock:
+                    self.update_servers_status()
+                if self.get_current_server_id() is None:
+                    self.set_current_server_id(self.get_best_server_id())
+                else:
+                    self.refresh_best_server()
+            except Exception as e:
+                logger.warning(f"Exception in best server refresh loop: {e}")
             time.sleep(config.MULTISERVER_REFRESH_BEST_SERVER_PERIOD)
+
+
+class ClientPoolCollector:
+    """Exports connection pool stats of ConnectionManager clients."""
+
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+
+    def collect(self):
+        opened = CounterMetricFamily(
+            "tron_client_connections_opened",
+            "Connections opened to fullnode",
+            labels=("server",),
+        )
+        reused = CounterMetricFamily(
+            "tron_client_connections_reused",
+            "Fullnode requests sent over an already open connection",
+            labels=("server",),
+        )
+        in_use = GaugeMetricFamily(
+            "tron_client_connections_in_use",
+            "Fullnode connections in use, requests wait or open extra "
+            "connections when it reaches the pool size",
+            labels=("server",),
+        )
+        size = GaugeMetricFamily(
+            "tron_client_pool_size",
+            "Fullnode connection pool size",
+            labels=("server",),
+        )
+        for server, stats in self.manager.get_pool_stats().items():
+            opened.add_metric([server], stats["opened"])
+            reused.add_metric([server], max(0, stats["requests"] - stats["opened"]))
+            in_use.add_metric([server], stats["in_use"])
+            size.add_metric([server], stats["size"])
+        return [opened, reused, in_use, size]
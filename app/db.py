@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 import sqlite3
 import time
 
@@ -72,6 +73,26 @@ def query_db2(query, args=(), one=False):
     return (rv[0] if rv else None) if one else rv
 
 
+@contextmanager
+def transaction_db2():
+    """Runs queries on a new connection within one write transaction."""
+    db = sqlite3.connect(
+        config.DATABASE, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None
+    )
+    db.execute("pragma journal_mode=wal;")
+    db.row_factory = sqlite3.Row
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+
 def init_db(app):
     with app.app_context():
         db = get_db()
@@ -0,0 +1,185 @@
+import json
+import queue
+import time
+
+import zmq
+
+from .block_scanner import BlockScanner, to_raw_hex_address
+from .config import config
+from .logging import logger
+
+
+class EventListener:
+    """
+    Receives blocks from the java-tron event plugin (native ZeroMQ queue,
+    `event.subscribe.native.useNativeQueue = true`) and hands them to the
+    block scanner, which scans them with BlockScanner.scan() as soon as they
+    arrive.
+
+    Transaction triggers are converted to the visible=False format of
+    wallet/getblockbynum, their logs (the `logList` of the transaction
+    trigger or contract log triggers) to the format of
+    wallet/gettransactioninfobyid. A block is handed over once all
+    transactions announced by its block trigger and the logs of its
+    successful contract calls are received. Blocks still incomplete
+    MAX_PENDING_BLOCKS blocks later are dropped and downloaded by the
+    polling scanner, which stays EVENT_LISTENER_POLL_DELAY blocks behind the
+    head to fill such gaps, as well as blocks which don't fit in the
+    scanner's event queue.
+
+    Events are received only while the scanner holds its lease, other
+    processes don't subscribe.
+    """
+
+    # trigger names the native queue publishes under, not the config keys
+    TOPICS = ("blockTrigger", "transactionTrigger", "contractLogTrigger")
+    # incomplete blocks older than that are dropped
+    MAX_PENDING_BLOCKS = 100
+
+    def __init__(self, scanner: BlockScanner):
+        self.scanner = scanner
+        self.blocks = {}
+
+    def __call__(self):
+        while True:
+            try:
+                self.wait_for_lease()
+                self.listen()
+            except Exception as e:
+                sleep_sec = 5
+                logger.exception(f"Exteption in event listener loop: {e}")
+                logger.warning(f"Waiting {sleep_sec} seconds before retry.")
+                time.sleep(sleep_sec)
+
+    def is_leader(self) -> bool:
+        return self.scanner.lease is None or self.scanner.lease.is_valid()
+
+    def wait_for_lease(self):
+        while not self.is_leader():
+            time.sleep(1)
+
+    def listen(self):
+        """Receives events until the scanner loses its lease."""
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        try:
+            socket.connect(config.EVENT_LISTENER_ZMQ_URL)
+            for topic in self.TOPICS:
+                socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+            logger.info(f"Listening for events on {config.EVENT_LISTENER_ZMQ_URL}")
+            while self.is_leader():
+                if not socket.poll(1000):
+                    continue
+                topic, payload = socket.recv_multipart()
+                self.handle_event(topic.decode(), json.loads(payload))
+            logger.info("Stopped listening for events, the scanner lease is lost")
+        finally:
+            socket.close(linger=0)
+            self.blocks = {}
+
+    def get_pending_block(self, block_num: int) -> dict:
+        if block_num not in self.blocks:
+            self.blocks[block_num] = {
+                "size": None,
+                "transactions": {},
+                "log_lists": {},
+                "contract_logs": {},
+            }
+        return self.blocks[block_num]
+
+    def handle_event(self, topic: str, event: dict):
+        if topic == "blockTrigger":
+            block_num = event["blockNumber"]
+            self.get_pending_block(block_num)["size"] = event["transactionSize"]
+            self.drop_old_blocks(block_num)
+        elif topic == "transactionTrigger":
+            block_num = event["blockNumber"]
+            pending = self.get_pending_block(block_num)
+            txid = event["transactionId"]
+            pending["transactions"][txid] = to_raw_transaction(event)
+            if event.get("logList") is not None:
+                pending["log_lists"][txid] = [
+                    to_raw_log(entry, "topicList") for entry in event["logList"]
+                ]
+        elif topic == "contractLogTrigger":
+            if event.get("removed"):
+                return
+            block_num = event["blockNumber"]
+            pending = self.get_pending_block(block_num)
+            pending["contract_logs"].setdefault(event["transactionId"], []).append(
+                to_raw_log(event["rawData"], "topics")
+            )
+        else:
+            return
+        self.check_block(block_num)
+
+    def drop_old_blocks(self, block_num: int):
+        for n in [n for n in self.blocks if n < block_num - self.MAX_PENDING_BLOCKS]:
+            logger.debug(f"Block {n}: Incomplete events, left to polling")
+            del self.blocks[n]
+
+    def check_block(self, block_num: int):
+        pending = self.blocks.get(block_num)
+        if pending is None:
+            return
+        if pending["size"] is None or len(pending["transactions"]) < pending["size"]:
+            return
+
+        block_tx_info = {}
+        for txid, tx in pending["transactions"].items():
+            if txid in pending["log_lists"]:
+                logs = pending["log_lists"][txid]
+            elif txid in pending["contract_logs"]:
+                logs = pending["contract_logs"][txid]
+            elif (
+                tx["raw_data"]["contract"][0]["type"] == "TriggerSmartContract"
+                and tx["ret"][0]["contractRet"] == "SUCCESS"
+            ):
+                # Contract log triggers may come after the transaction
+                # trigger. A call without logs can't be told from one whose
+                # logs are yet to come, such blocks are dropped by
+                # drop_old_blocks() and left to polling.
+                return
+            else:
+                continue
+            if logs:
+                block_tx_info[txid] = {"id": txid, "log": logs}
+        del self.blocks[block_num]
+
+        block = {"block_header": {"raw_data": {"number": block_num}}}
+        if pending["transactions"]:
+            block["transactions"] = list(pending["transactions"].values())
+        try:
+            self.scanner.event_queue.put_nowait((block_num, block, block_tx_info))
+        except queue.Full:
+            logger.debug(f"Block {block_num}: Event queue is full, left to polling")
+        else:
+            logger.debug(f"Block {block_num}: Received from events")
+
+
+def to_raw_transaction(event: dict) -> dict:
+    """Converts a transaction trigger to a visible=False transaction."""
+    contract_type = event.get("contractType")
+    value = {}
+    if event.get("fromAddress"):
+        value["owner_address"] = "41" + to_raw_hex_address(event["fromAddress"])
+    if contract_type == "TransferContract":
+        value["to_address"] = "41" + to_raw_hex_address(event["toAddress"])
+        value["amount"] = event["assetAmount"]
+    elif contract_type == "TriggerSmartContract" and event.get("toAddress"):
+        value["contract_address"] = "41" + to_raw_hex_address(event["toAddress"])
+    return {
+        "txID": event["transactionId"],
+        "ret": [{"contractRet": event.get("result")}],
+        "raw_data": {
+            "contract": [{"type": contract_type, "parameter": {"value": value}}]
+        },
+    }
+
+
+def to_raw_log(entry: dict, topics_key: str) -> dict:
+    """Converts a trigger log entry to a visible=False tx info log."""
+    return {
+        "address": to_raw_hex_address(entry["address"]),
+        "topics": [topic.removeprefix("0x") for topic in entry[topics_key]],
+        "data": entry.get("data", "").removeprefix("0x"),
+    }
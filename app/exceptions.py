@@ -20,3 +20,7 @@ class NoServerSet(Exception):
 
 class UnknownToken(Exception):
     pass
+
+
+class LeaseLost(Exception):
+    pass
@@ -0,0 +1,128 @@
+"""
+Fast decoding of fullnode responses.
+
+JSON_DECODER selects the decoder: "msgspec", "orjson", "json" (stdlib) or
+"auto" for the first installed one in that order. msgspec decodes blocks
+and tx infos into the TypedDicts below, so only the fields the block scanner
+reads are kept. The result is the same dicts as with the other decoders,
+just without the unused fields.
+"""
+
+import functools
+import json
+from typing import Any, List, TypedDict
+
+from .config import config
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ContractValue(TypedDict, total=False):
+    owner_address: str
+    to_address: str
+    contract_address: str
+    amount: Any
+
+
+class ContractParameter(TypedDict, total=False):
+    value: ContractValue
+
+
+class Contract(TypedDict, total=False):
+    type: str
+    parameter: ContractParameter
+
+
+class TransactionRawData(TypedDict, total=False):
+    contract: List[Contract]
+
+
+class TransactionResult(TypedDict, total=False):
+    contractRet: str
+
+
+class Transaction(TypedDict, total=False):
+    txID: str
+    ret: List[TransactionResult]
+    raw_data: TransactionRawData
+
+
+class BlockRawData(TypedDict, total=False):
+    number: int
+    timestamp: int
+
+
+class BlockHeader(TypedDict, total=False):
+    raw_data: BlockRawData
+
+
+class Block(TypedDict, total=False):
+    blockID: str
+    block_header: BlockHeader
+    transactions: List[Transaction]
+
+
+class BlockList(TypedDict, total=False):
+    block: List[Block]
+
+
+class Log(TypedDict, total=False):
+    address: str
+    topics: List[str]
+    data: str
+
+
+class TransactionInfo(TypedDict, total=False):
+    id: str
+    blockNumber: int
+    log: List[Log]
+
+
+RESPONSE_TYPES = {
+    "wallet/getblockbynum": Block,
+    "wallet/getblockbylimitnext": BlockList,
+    "wallet/gettransactioninfobyblocknum": List[TransactionInfo],
+    "wallet/gettransactioninfobyid": TransactionInfo,
+}
+
+
+@functools.cache
+def get_decoder_name() -> str:
+    name = config.JSON_DECODER
+    if name == "auto":
+        if msgspec is not None:
+            return "msgspec"
+        if orjson is not None:
+            return "orjson"
+        return "json"
+    if name == "msgspec" and msgspec is None:
+        raise ImportError("JSON_DECODER is msgspec but msgspec is not installed")
+    if name == "orjson" and orjson is None:
+        raise ImportError("JSON_DECODER is orjson but orjson is not installed")
+    return name
+
+
+@functools.cache
+def get_msgspec_decoder(method: str | None):
+    return msgspec.json.Decoder(RESPONSE_TYPES.get(method, Any))
+
+
+def loads(data: bytes, method: str | None = None):
+    """
+    Decodes a response body. Responses of the `method` fullnode API method
+    are decoded to typed dicts if it is listed in RESPONSE_TYPES.
+    """
+    name = get_decoder_name()
+    if name == "msgspec":
+        return get_msgspec_decoder(method).decode(data)
+    if name == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
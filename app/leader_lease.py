@@ -0,0 +1,95 @@
+import os
+import socket
+import time
+import uuid
+
+from .config import config
+from .db import query_db2, transaction_db2
+from .exceptions import LeaseLost
+from .logging import logger
+
+
+class LeaderLease:
+    """
+    Lease in the leases table which lets only one of the processes sharing
+    the database run a singleton service, e.g. the block scanner. The holder
+    renews it every LEADER_LEASE_TTL / 3 seconds, a lease not renewed for
+    LEADER_LEASE_TTL seconds is taken over by another process.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self.renewed_at = 0
+
+    @property
+    def renew_period(self) -> float:
+        return config.LEADER_LEASE_TTL / 3
+
+    def try_acquire(self) -> bool:
+        """Acquires or renews the lease, returns True if it is held."""
+        now = time.time()
+        with transaction_db2() as db:
+            # the conditional upsert is atomic, only one process can take
+            # over an expired lease
+            db.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                "  owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (self.name, self.owner, now + config.LEADER_LEASE_TTL, now),
+            )
+            row = db.execute(
+                "SELECT owner FROM leases WHERE name = ?", (self.name,)
+            ).fetchone()
+        held = row["owner"] == self.owner
+        if held and not self.held:
+            logger.info(f"Acquired {self.name} lease as {self.owner}")
+        elif self.held and not held:
+            logger.warning(f"Lost {self.name} lease to {row['owner']}")
+        self.held = held
+        if held:
+            self.renewed_at = now
+        return held
+
+    def is_valid(self) -> bool:
+        """Returns True if the lease is held and not expired."""
+        return self.held and time.time() < self.renewed_at + config.LEADER_LEASE_TTL
+
+    def fence(self, db):
+        """
+        Raises LeaseLost unless the lease is held and not expired. Called
+        within write transactions of the lease holder, so their writes are
+        committed only while it holds the lease.
+        """
+        row = db.execute(
+            "SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,)
+        ).fetchone()
+        if (
+            row is None
+            or row["owner"] != self.owner
+            or row["expires_at"] <= time.time()
+        ):
+            self.held = False
+            raise LeaseLost(f"{self.name} lease is not held by {self.owner}")
+
+    def wait(self):
+        """Blocks until the lease is acquired."""
+        while not self.try_acquire():
+            logger.debug(f"Waiting for {self.name} lease")
+            time.sleep(self.renew_period)
+
+    def check(self):
+        """Renews the lease when due, raises LeaseLost if it is not held."""
+        if self.held and time.time() - self.renewed_at < self.renew_period:
+            return
+        if not self.try_acquire():
+            raise LeaseLost(f"{self.name} lease is held by another process")
+
+    def release(self):
+        """Gives up the lease if held, so another process can take it over."""
+        query_db2(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner)
+        )
+        self.held = False
@@ -0,0 +1,74 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+
+scanner_downloaded_bytes = Counter(
+    "tron_scanner_downloaded_bytes",
+    "Bytes downloaded from fullnode by the block scanner",
+    ("method",),
+)
+scanner_blocks_tx_info = Counter(
+    "tron_scanner_blocks_tx_info",
+    "Scanned blocks by the way their transaction info was obtained",
+    ("mode",),
+)
+scanner_request_seconds = Histogram(
+    "tron_scanner_request_seconds",
+    "Fullnode request latency of the block scanner",
+    ("method",),
+)
+scanner_response_bytes = Histogram(
+    "tron_scanner_response_bytes",
+    "Fullnode response size of the block scanner requests",
+    ("method",),
+    buckets=(1_000, 10_000, 100_000, 500_000, 1_000_000, 5_000_000, 20_000_000),
+)
+scanner_stage_seconds = Histogram(
+    "tron_scanner_stage_seconds",
+    "Time spent per block in a block scanner stage",
+    ("stage",),
+)
+scanner_matched_transfers = Counter(
+    "tron_scanner_matched_transfers",
+    "Transfers to watched accounts found by the block scanner",
+    ("symbol",),
+)
+scanner_block_retries = Counter(
+    "tron_scanner_block_retries",
+    "Blocks the block scanner failed to download or scan and retries",
+)
+scanner_lag_blocks = Gauge(
+    "tron_scanner_lag_blocks",
+    "Number of blocks between the last scanned block and the fullnode head",
+)
+notifications_sent = Counter(
+    "tron_notifications_sent",
+    "Notifications delivered to SHKeeper",
+)
+notifications_failed = Counter(
+    "tron_notifications_failed",
+    "Notification delivery attempts failed",
+)
+actions_failed = Counter(
+    "tron_actions_failed",
+    "Runs of actions on found transfers (sweeps, AML checks) failed",
+)
+scanner_fetch_concurrency = Gauge(
+    "tron_scanner_fetch_concurrency",
+    "Number of blocks the block scanner downloads ahead of processing",
+)
+client_hedge_eligible_requests = Counter(
+    "tron_client_hedge_eligible_requests",
+    "Fullnode requests of methods that may be hedged",
+)
+client_hedged_requests = Counter(
+    "tron_client_hedged_requests",
+    "Fullnode requests also sent to a second server after a slow response",
+)
+client_hedge_wins = Counter(
+    "tron_client_hedge_wins",
+    "Hedged fullnode requests answered by the second server first",
+)
+scanner_commit_batch_size = Gauge(
+    "tron_scanner_commit_batch_size",
+    "Number of processed blocks per last seen block update",
+)
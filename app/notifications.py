@@ -0,0 +1,171 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import metrics
+from .config import config
+from .db import query_db2
+from .exceptions import NotificationFailed
+from .leader_lease import LeaderLease
+from .logging import logger
+
+
+class NotificationDispatcher:
+    """
+    Delivers notifications written to the outbox by the block scanner to
+    SHKeeper. Failed deliveries are retried with exponential backoff, a
+    notification is removed from the outbox only after SHKeeper accepted it.
+
+    With NOTIFICATION_BATCH_MODE the outbox is drained every
+    NOTIFICATION_BATCH_WINDOW seconds and all due notifications of a symbol
+    are sent in one request carrying the parsed transfers, so SHKeeper does
+    not need to call back /transaction/<txid> for each of them.
+    """
+
+    def __init__(self, lease: LeaderLease | None = None):
+        # delivers only while the block scanner lease is held, if given
+        self.lease = lease
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=config.NOTIFICATION_DISPATCHER_CONCURRENCY
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self):
+        with ThreadPoolExecutor(
+            max_workers=config.NOTIFICATION_DISPATCHER_CONCURRENCY
+        ) as executor:
+            while True:
+                try:
+                    if not self.is_leader():
+                        time.sleep(config.NOTIFICATION_DISPATCHER_POLL_PERIOD)
+                        continue
+                    if config.NOTIFICATION_BATCH_MODE:
+                        time.sleep(config.NOTIFICATION_BATCH_WINDOW)
+                        batches = self.get_due_batches()
+                        list(executor.map(self.deliver_batch, batches))
+                        continue
+                    notifications = self.get_due_notifications()
+                    if not notifications:
+                        time.sleep(config.NOTIFICATION_DISPATCHER_POLL_PERIOD)
+                        continue
+                    list(executor.map(self.deliver, notifications))
+                except Exception as e:
+                    sleep_sec = 60
+                    logger.exception(f"Exteption in notification dispatcher loop: {e}")
+                    logger.warning(f"Waiting {sleep_sec} seconds before retry.")
+                    time.sleep(sleep_sec)
+
+    def is_leader(self) -> bool:
+        # The lease is renewed by the block scanner thread. An expired lease
+        # may be taken over by another process even if it is still marked
+        # as held here.
+        return self.lease is None or self.lease.is_valid()
+
+    def get_due_notifications(self, limit: int | None = None) -> list:
+        if limit is None:
+            limit = config.NOTIFICATION_DISPATCHER_CONCURRENCY * 10
+        return query_db2(
+            "SELECT * FROM notification_outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit),
+        )
+
+    def get_due_batches(self) -> list:
+        notifications = self.get_due_notifications(
+            config.NOTIFICATION_DISPATCHER_CONCURRENCY
+            * config.NOTIFICATION_BATCH_MAX_SIZE
+        )
+        by_symbol = {}
+        for notification in notifications:
+            by_symbol.setdefault(notification["symbol"], []).append(notification)
+        return [
+            batch[i : i + config.NOTIFICATION_BATCH_MAX_SIZE]
+            for batch in by_symbol.values()
+            for i in range(0, len(batch), config.NOTIFICATION_BATCH_MAX_SIZE)
+        ]
+
+    def notify_shkeeper(self, symbol, txid):
+        url = f"http://{config.SHKEEPER_HOST}/api/v1/walletnotify/{symbol}/{txid}"
+        headers = {"X-Shkeeper-Backend-Key": config.SHKEEPER_BACKEND_KEY}
+        res = self.session.post(
+            url, headers=headers, timeout=config.NOTIFICATION_TIMEOUT
+        ).json()
+        logger.info(f"Shkeeper response: {res}")
+        if res["status"] != "success":
+            raise NotificationFailed(res)
+
+    def notify_shkeeper_batch(self, symbol, transactions: list):
+        url = f"http://{config.SHKEEPER_HOST}/api/v1/walletnotify/{symbol}"
+        headers = {"X-Shkeeper-Backend-Key": config.SHKEEPER_BACKEND_KEY}
+        res = self.session.post(
+            url,
+            headers=headers,
+            json={"transactions": transactions},
+            timeout=config.NOTIFICATION_TIMEOUT,
+        ).json()
+        logger.info(f"Shkeeper response: {res}")
+        if res["status"] != "success":
+            raise NotificationFailed(res)
+
+    def deliver_batch(self, notifications: list):
+        if not self.is_leader():
+            return
+        symbol = notifications[0]["symbol"]
+        transactions = [
+            {
+                "txid": notification["txid"],
+                "symbol": notification["symbol"],
+                "src": notification["src"],
+                "dst": notification["dst"],
+                "amount": str(notification["amount"]),
+                "block_num": notification["block_num"],
+            }
+            for notification in notifications
+        ]
+        try:
+            logger.info(f"Sending {len(transactions)} {symbol} notifications")
+            self.notify_shkeeper_batch(symbol, transactions)
+        except Exception as e:
+            metrics.notifications_failed.inc(len(notifications))
+            self.reschedule(notifications, e)
+        else:
+            metrics.notifications_sent.inc(len(notifications))
+            query_db2(
+                f"DELETE FROM notification_outbox WHERE id IN ({','.join('?' * len(notifications))})",
+                [notification["id"] for notification in notifications],
+            )
+
+    def deliver(self, notification):
+        if not self.is_leader():
+            return
+        try:
+            logger.info(
+                f"Sending notification for {notification['symbol']} TXID {notification['txid']}"
+            )
+            self.notify_shkeeper(notification["symbol"], notification["txid"])
+        except Exception as e:
+            metrics.notifications_failed.inc()
+            self.reschedule([notification], e)
+        else:
+            metrics.notifications_sent.inc()
+            query_db2(
+                "DELETE FROM notification_outbox WHERE id = ?", (notification["id"],)
+            )
+
+    def reschedule(self, notifications: list, error: Exception):
+        for notification in notifications:
+            attempts = notification["attempts"] + 1
+            delay = min(
+                config.NOTIFICATION_RETRY_MAX_DELAY,
+                config.NOTIFICATION_RETRY_INITIAL_DELAY * 2 ** (attempts - 1),
+            )
+            logger.warning(
+                f"Notification for TXID {notification['txid']} failed "
+                f"(attempt {attempts}), retrying in {delay}s: {error}"
+            )
+            query_db2(
+                "UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, str(error), notification["id"]),
+            )
@@ -0,0 +1,85 @@
+import collections
+import statistics
+import threading
+
+from . import metrics
+from .config import config
+from .logging import logger
+
+
+class AdaptiveController:
+    """
+    Picks how many blocks the scanner fetches in parallel and how many
+    processed blocks are committed per watermark update.
+
+    Concurrency starts at `initial` and doubles after every round of
+    successful fetches (slow start) until the first slowdown, then grows by
+    one per round while the scanner lags behind the head. It is halved when
+    the median fetch latency exceeds BLOCK_SCANNER_ADAPTIVE_TARGET_LATENCY
+    or the error rate exceeds BLOCK_SCANNER_ADAPTIVE_MAX_ERROR_RATE. With
+    adaptive=False both values stay fixed at `initial` and 1.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, adaptive: bool):
+        self.adaptive = adaptive
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        if adaptive:
+            self.concurrency = min(max(initial, self.minimum), self.maximum)
+        else:
+            self.concurrency = max(1, initial)
+        self.commit_batch_size = 1
+        self.slow_start = True
+        self.samples = collections.deque(maxlen=self.maximum)
+        self.lock = threading.Lock()
+        self.export()
+
+    def record_fetch(self, seconds: float, is_fetched: bool):
+        with self.lock:
+            self.samples.append((seconds, is_fetched))
+
+    def update(self, lag: int):
+        metrics.scanner_lag_blocks.set(lag)
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            if len(self.samples) < min(self.concurrency, self.samples.maxlen):
+                samples = None
+            else:
+                samples = list(self.samples)
+                self.samples.clear()
+
+        if samples:
+            latencies = [seconds for seconds, is_fetched in samples if is_fetched]
+            error_rate = 1 - len(latencies) / len(samples)
+            latency = statistics.median(latencies) if latencies else 0
+            if (
+                error_rate > config.BLOCK_SCANNER_ADAPTIVE_MAX_ERROR_RATE
+                or latency > config.BLOCK_SCANNER_ADAPTIVE_TARGET_LATENCY
+            ):
+                self.slow_start = False
+                self.concurrency = max(self.minimum, self.concurrency // 2)
+                logger.info(
+                    f"Scanner fetch concurrency decreased to {self.concurrency} "
+                    f"({latency=:.3f}s {error_rate=:.2f})"
+                )
+            elif lag > self.concurrency:
+                if self.slow_start:
+                    self.concurrency = min(self.maximum, self.concurrency * 2)
+                else:
+                    self.concurrency = min(self.maximum, self.concurrency + 1)
+                logger.debug(
+                    f"Scanner fetch concurrency increased to {self.concurrency}"
+                )
+
+        # Commit every block near the head, fewer watermark updates while
+        # catching up
+        self.commit_batch_size = max(
+            1, min(config.BLOCK_SCANNER_MAX_COMMIT_BATCH_SIZE, lag // 10)
+        )
+        self.export()
+
+    def export(self):
+        metrics.scanner_fetch_concurrency.set(self.concurrency)
+        metrics.scanner_commit_batch_size.set(self.commit_batch_size)
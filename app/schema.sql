@@ -10,4 +10,56 @@ CREATE TABLE IF NOT EXISTS settings (
   `name` TEXT NOT NULL,
   `value` TEXT,
   UNIQUE(`name`)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS notification_outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  symbol TEXT NOT NULL,
+  txid TEXT NOT NULL,
+  src TEXT,
+  dst TEXT,
+  amount DECTEXT,
+  block_num INTEGER NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at REAL NOT NULL DEFAULT 0,
+  last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS notification_outbox_next_attempt_at
+  ON notification_outbox (next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS action_outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  action TEXT NOT NULL,
+  symbol TEXT NOT NULL,
+  txid TEXT NOT NULL,
+  dst TEXT,
+  amount DECTEXT,
+  block_num INTEGER NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at REAL NOT NULL DEFAULT 0,
+  last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS action_outbox_next_attempt_at
+  ON action_outbox (next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS scanned_blocks (
+  block_num INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS processed_transfers (
+  txid TEXT NOT NULL,
+  log_index INTEGER NOT NULL,
+  block_num INTEGER NOT NULL,
+  PRIMARY KEY (txid, log_index)
+);
+
+CREATE INDEX IF NOT EXISTS processed_transfers_block_num
+  ON processed_transfers (block_num);
+
+CREATE TABLE IF NOT EXISTS leases (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at REAL NOT NULL
+);
@@ -57,6 +57,9 @@ class TronTransaction(BaseModel):
     dst_addr: TronAddress
     amount: Decimal
     is_trc20: bool
+    block_num: int | None = None
+    # index of the Transfer event in the transaction log, 0 for TRX transfers
+    log_index: int = 0
 
 
 class Token(BaseModel):
@@ -1,6 +1,5 @@
-import threading
-
 import app
+import scanner
 
 
 #
@@ -9,17 +8,6 @@ import app
 
 app.wallet_encryption.setup_encryption()
 
-#
-# Refresh best server
-#
-
-refresh_best_server_thread = threading.Thread(
-    daemon=True,
-    name="Refresh best server",
-    target=app.connection_manager.ConnectionManager.manager().refresh_best_server_thread_handler,
-)
-refresh_best_server_thread.start()
-
 #
 # Flask
 #
@@ -30,19 +18,6 @@ server = app.create_app()
 # Block scanner
 #
 
-block_scanner = app.block_scanner.BlockScanner()
-
-block_scanner_thread = threading.Thread(
-    daemon=True,
-    name="Block Scanner",
-    target=block_scanner,
-)
-block_scanner_thread.start()
-
-block_scanner_stats_thread = threading.Thread(
-    daemon=True,
-    name="Scanner Stats",
-    target=app.block_scanner.block_scanner_stats,
-    args=(block_scanner,),
-)
-block_scanner_stats_thread.start()
+if app.config.config.BLOCK_SCANNER_EMBEDDED:
+    # one of the API workers scans, see scanner.py for a separate service
+    scanner.start_services()
@@ -0,0 +1,119 @@
+"""
+Block scanner service.
+
+Runs the block scanner, the notification dispatcher and their helper
+threads without the API:
+
+    python scanner.py
+
+Set BLOCK_SCANNER_EMBEDDED=false for the API process (run.py) then. Only one
+scanner sharing the database scans at a time, the others wait for its leader
+lease to expire, so the service can be run with a hot standby. The lease is
+released on clean shutdown.
+"""
+
+import atexit
+import signal
+import sys
+import threading
+
+import prometheus_client
+
+import app
+import app.actions
+import app.notifications
+from app.config import config
+from app.connection_manager import ConnectionManager
+from app.leader_lease import LeaderLease
+
+
+def start_services() -> threading.Thread:
+    """Starts the block scanner and its helper threads in the background."""
+
+    #
+    # Refresh best server
+    #
+
+    refresh_best_server_thread = threading.Thread(
+        daemon=True,
+        name="Refresh best server",
+        target=ConnectionManager.manager().refresh_best_server_thread_handler,
+    )
+    refresh_best_server_thread.start()
+
+    #
+    # Block scanner
+    #
+
+    lease = LeaderLease("block_scanner")
+    # let a standby take over right away on clean shutdown
+    atexit.register(lease.release)
+    if config.BLOCK_SCANNER_ENGINE == "asyncio":
+        from app.async_block_scanner import AsyncBlockScanner
+
+        block_scanner = AsyncBlockScanner(lease=lease)
+    else:
+        block_scanner = app.block_scanner.BlockScanner(lease=lease)
+
+    block_scanner_thread = threading.Thread(
+        daemon=True,
+        name="Block Scanner",
+        target=block_scanner,
+    )
+    block_scanner_thread.start()
+
+    if config.EVENT_LISTENER_ENABLED:
+        from app.event_listener import EventListener
+
+        event_listener_thread = threading.Thread(
+            daemon=True,
+            name="Event Listener",
+            target=EventListener(block_scanner),
+        )
+        event_listener_thread.start()
+
+    block_scanner_stats_thread = threading.Thread(
+        daemon=True,
+        name="Scanner Stats",
+        target=app.block_scanner.block_scanner_stats,
+        args=(block_scanner,),
+    )
+    block_scanner_stats_thread.start()
+
+    #
+    # Notifications
+    #
+
+    notification_dispatcher_thread = threading.Thread(
+        daemon=True,
+        name="Notification Dispatcher",
+        target=app.notifications.NotificationDispatcher(lease=lease),
+    )
+    notification_dispatcher_thread.start()
+
+    #
+    # Actions on found transfers
+    #
+
+    action_dispatcher_thread = threading.Thread(
+        daemon=True,
+        name="Action Dispatcher",
+        target=app.actions.ActionDispatcher(lease=lease),
+    )
+    action_dispatcher_thread.start()
+
+    return block_scanner_thread
+
+
+def main():
+    app.wallet_encryption.setup_encryption()
+    app.create_app()
+    # exit normally on SIGTERM so the leader lease is released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if config.BLOCK_SCANNER_METRICS_PORT:
+        prometheus_client.start_http_server(config.BLOCK_SCANNER_METRICS_PORT)
+    start_services().join()
+
+
+if __name__ == "__main__":
+    main()
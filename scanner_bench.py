@@ -0,0 +1,327 @@
+"""
+Block scanner benchmark.
+
+Record blocks and their tx infos from a fullnode into a compressed corpus:
+
+    python scanner_bench.py record --start 70000000 --count 1000 corpus.jsonl.gz
+
+Replay the corpus through the BlockScanner pipeline without network access:
+
+    python scanner_bench.py replay corpus.jsonl.gz --watch-sample 50
+
+Publish the corpus as java-tron event plugin triggers for the event
+listener (EVENT_LISTENER_ZMQ_URL=tcp://127.0.0.1:5555):
+
+    python scanner_bench.py publish corpus.jsonl.gz --url tcp://*:5555
+
+The corpus must be recorded from the network set by TRON_NETWORK, token
+contracts are looked up in the config during replay.
+"""
+
+import argparse
+import collections
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+from tronpy.keys import to_base58check_address
+
+from app.block_scanner import (
+    TRANSFER_EVENT,
+    BlockScanner,
+    get_token_contract_addresses,
+    to_base58_address,
+)
+from app.config import config
+from app.connection_manager import ConnectionManager
+
+
+class StopReplay(Exception):
+    pass
+
+
+class ReplayScanner(BlockScanner):
+    """
+    BlockScanner which serves fullnode requests from a recorded corpus,
+    keeps the watermark in memory and counts transfers instead of notifying.
+    """
+
+    def __init__(self, corpus: list):
+        super().__init__()
+        self.blocks = {}
+        self.tx_infos = {}
+        self.tx_infos_by_id = {}
+        for record in corpus:
+            num = record["num"]
+            self.blocks[num] = json.dumps(record["block"])
+            self.tx_infos[num] = json.dumps(record["tx_info"])
+            for tx_info in record["tx_info"]:
+                self.tx_infos_by_id[tx_info["id"]] = json.dumps(tx_info)
+        self.first_block = min(self.blocks)
+        self.last_block = max(self.blocks)
+        self.last_seen_block_num = self.first_block - 1
+        self.stage_times = collections.Counter()
+        self.stage_times_lock = threading.Lock()
+        self.transfers = 0
+        self.notifications = 0
+
+    def make_request(
+        self, method: str, params: dict, block_num: int | None = None, raw=False
+    ):
+        result = self.get_response(method, params)
+        if raw:
+            return json.dumps(result).encode()
+        return result
+
+    def get_response(self, method: str, params: dict):
+        if method == "wallet/getblockbynum":
+            return json.loads(self.blocks.get(params["num"], "{}"))
+        if method == "wallet/getblockbylimitnext":
+            return {
+                "block": [
+                    json.loads(self.blocks[n])
+                    for n in range(params["startNum"], params["endNum"])
+                    if n in self.blocks
+                ]
+            }
+        if method == "wallet/gettransactioninfobyblocknum":
+            return json.loads(self.tx_infos.get(params["num"], "[]"))
+        if method == "wallet/gettransactioninfobyid":
+            return json.loads(self.tx_infos_by_id.get(params["value"], "{}"))
+        raise ValueError(f"Unexpected request in replay: {method}")
+
+    def get_last_seen_block_num(self) -> int:
+        return self.last_seen_block_num
+
+    def get_scanned_blocks(self, last_seen_block_num: int) -> list:
+        return []
+
+    def set_last_seen_block_num(self, block_num: int, scanned_blocks: list = ()):
+        self.last_seen_block_num = block_num
+        if block_num >= self.last_block:
+            raise StopReplay()
+
+    def get_current_height(self):
+        return self.last_block
+
+    @classmethod
+    def sync_watched_accounts(cls):
+        # watched accounts are set by the benchmark, not the keys table
+        pass
+
+    def record_stage_time(self, stage: str, seconds: float):
+        with self.stage_times_lock:
+            self.stage_times[stage] += seconds
+
+    def is_processed_transfer(self, tron_tx) -> bool:
+        return False
+
+    def handle_transfer(self, tron_tx, valid_addresses):
+        self.transfers += 1
+        if tron_tx.dst_addr in valid_addresses and tron_tx.status == "SUCCESS":
+            self.notifications += 1
+
+
+def record(args):
+    provider = ConnectionManager.manager().get_client_for_server_id(args.server).provider
+    with gzip.open(args.corpus, "wt") as f:
+        for n in range(args.start, args.start + args.count):
+            block = provider.make_request(
+                "wallet/getblockbynum", {"num": n, "visible": False}
+            )
+            if "transactions" in block:
+                tx_info = provider.make_request(
+                    "wallet/gettransactioninfobyblocknum", {"num": n, "visible": False}
+                )
+            else:
+                tx_info = []
+            f.write(json.dumps({"num": n, "block": block, "tx_info": tx_info}) + "\n")
+            if (n - args.start + 1) % 100 == 0:
+                print(f"Recorded {n - args.start + 1} of {args.count} blocks")
+    print(f"Corpus saved to {args.corpus}")
+
+
+def get_destinations(corpus: list) -> list:
+    """Returns all TRX and token transfer destinations found in the corpus."""
+    token_contracts = get_token_contract_addresses()
+    destinations = set()
+    for record in corpus:
+        for tx in record["block"].get("transactions", []):
+            contract = tx["raw_data"]["contract"][0]
+            if contract["type"] == "TransferContract":
+                destinations.add(contract["parameter"]["value"]["to_address"])
+        for tx_info in record["tx_info"]:
+            for entry in tx_info.get("log", []):
+                topics = entry.get("topics", [])
+                if (
+                    len(topics) == 3
+                    and topics[0] == TRANSFER_EVENT
+                    and entry["address"][-40:] in token_contracts
+                ):
+                    destinations.add(topics[2])
+    return sorted(to_base58_address(address) for address in destinations)
+
+
+def replay(args):
+    with gzip.open(args.corpus, "rt") as f:
+        corpus = [json.loads(line) for line in f]
+    if not corpus:
+        raise SystemExit(f"Corpus {args.corpus} is empty")
+
+    rnd = random.Random(args.seed)
+    watched = []
+    if args.watch:
+        with open(args.watch) as f:
+            watched.extend(line.strip() for line in f if line.strip())
+    destinations = get_destinations(corpus)
+    watched.extend(rnd.sample(destinations, min(args.watch_sample, len(destinations))))
+    watched.extend(
+        to_base58check_address(b"\x41" + os.urandom(20))
+        for _ in range(args.watch_extra)
+    )
+
+    if args.no_block_cache:
+        config.BLOCK_CACHE_MAX_ENTRIES = 0
+    else:
+        # the scanner writes every block to the cache, measure that too
+        # without touching the real cache database
+        cache_dir = tempfile.TemporaryDirectory()
+        config.BLOCK_CACHE_DATABASE = os.path.join(cache_dir.name, "block_cache.db")
+
+    scanner = ReplayScanner(corpus)
+    scanner.set_watched_accounts(watched)
+    txs = sum(len(record["block"].get("transactions", [])) for record in corpus)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=scanner.get_max_fetch_workers()) as executor:
+        try:
+            scanner.run_pipeline(executor)
+        except StopReplay:
+            pass
+    elapsed = time.perf_counter() - start_time
+
+    print(
+        f"blocks={len(corpus)} txs={txs} watched={scanner.count_watched_accounts()} "
+        f"transfers={scanner.transfers} notifications={scanner.notifications}"
+    )
+    print(
+        f"elapsed={elapsed:.3f}s blocks/s={len(corpus) / elapsed:.1f} "
+        f"txs/s={txs / elapsed:.1f}"
+    )
+    for stage in ("download", "match", "parse", "notify"):
+        seconds = scanner.stage_times[stage]
+        print(
+            f"{stage:>8}: {seconds:.3f}s total, "
+            f"{seconds / len(corpus) * 1000:.3f}ms per block"
+        )
+
+
+def to_transaction_trigger(num: int, tx: dict, tx_info: dict) -> dict:
+    contract = tx["raw_data"]["contract"][0]
+    value = contract["parameter"]["value"]
+    return {
+        "transactionId": tx["txID"],
+        "blockNumber": num,
+        "contractType": contract["type"],
+        "fromAddress": value.get("owner_address"),
+        "toAddress": value.get("to_address", value.get("contract_address")),
+        "assetAmount": value.get("amount", 0),
+        "result": tx["ret"][0]["contractRet"],
+        "logList": [
+            {
+                "address": entry["address"],
+                "topicList": entry.get("topics", []),
+                "data": entry.get("data", ""),
+            }
+            for entry in tx_info.get("log", [])
+        ],
+    }
+
+
+def publish(args):
+    with gzip.open(args.corpus, "rt") as f:
+        corpus = [json.loads(line) for line in f]
+
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.bind(args.url)
+    # give subscribers time to connect
+    time.sleep(1)
+    for record in corpus:
+        num = record["num"]
+        transactions = record["block"].get("transactions", [])
+        tx_infos = {tx_info["id"]: tx_info for tx_info in record["tx_info"]}
+        # java-tron posts the block trigger before the transaction triggers
+        block_trigger = {
+            "blockNumber": num,
+            "transactionSize": len(transactions),
+            "transactionList": [tx["txID"] for tx in transactions],
+        }
+        socket.send_multipart([b"blockTrigger", json.dumps(block_trigger).encode()])
+        for tx in transactions:
+            trigger = to_transaction_trigger(num, tx, tx_infos.get(tx["txID"], {}))
+            socket.send_multipart(
+                [b"transactionTrigger", json.dumps(trigger).encode()]
+            )
+        print(f"Published block {num} with {len(transactions)} transactions")
+        time.sleep(args.interval)
+    socket.close(linger=1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Block scanner benchmark")
+    subparsers = parser.add_subparsers(required=True)
+
+    record_parser = subparsers.add_parser("record", help="record a block corpus")
+    record_parser.add_argument("corpus", help="output file (.jsonl.gz)")
+    record_parser.add_argument("--start", type=int, required=True)
+    record_parser.add_argument("--count", type=int, default=1000)
+    record_parser.add_argument(
+        "--server", type=int, default=0, help="server ID to record from"
+    )
+    record_parser.set_defaults(func=record)
+
+    replay_parser = subparsers.add_parser("replay", help="replay a block corpus")
+    replay_parser.add_argument("corpus", help="input file (.jsonl.gz)")
+    replay_parser.add_argument("--watch", help="file with watched addresses")
+    replay_parser.add_argument(
+        "--watch-sample",
+        type=int,
+        default=0,
+        help="watch N random transfer destinations from the corpus",
+    )
+    replay_parser.add_argument(
+        "--watch-extra",
+        type=int,
+        default=0,
+        help="watch N random addresses to simulate a large watched set",
+    )
+    replay_parser.add_argument("--seed", type=int, default=0)
+    replay_parser.add_argument(
+        "--no-block-cache",
+        action="store_true",
+        help="disable the on-disk block cache to measure the scanner alone",
+    )
+    replay_parser.set_defaults(func=replay)
+
+    publish_parser = subparsers.add_parser(
+        "publish", help="publish a block corpus as event plugin triggers"
+    )
+    publish_parser.add_argument("corpus", help="input file (.jsonl.gz)")
+    publish_parser.add_argument("--url", default="tcp://*:5555")
+    publish_parser.add_argument(
+        "--interval", type=float, default=3, help="seconds between blocks"
+    )
+    publish_parser.set_defaults(func=publish)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()